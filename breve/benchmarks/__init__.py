@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+micro benchmarks for compiling, rendering and flattening, run with
+
+    python -m breve.benchmarks [-n NUMBER] [-r REPEAT] [-o FILE] [name ...]
+
+which prints the results as JSON, so they can be compared across
+releases.  Every benchmark is a function returning the callable to time,
+so that its setup isn't timed.
+"""
+import os
+import platform
+import sys
+import timeit
+
+import breve
+from breve.cache import Cache
+from breve.flatten import flatten
+from breve.loaders import FileLoader
+from breve.tags.html import tags as T
+from breve.tags.jsmin import jsmin
+from breve.template import Template
+from breve.util import escape
+
+benchmarks = {}
+
+_templates = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'tests', 'templates')
+
+# test templates that render with the same parameters
+_test_templates = [
+    'test_simple_template', 'test_include', 'test_nested_include', 'test_loop_include',
+    'test_include_macros', 'test_nested_include_macros', 'test_macro_includes',
+    'test_simple_inheritance', 'test_nested_inheritance', 'test_macros_inside_inherits',
+]
+
+_params = dict(
+    message='hello, from breve',
+    title='benchmark',
+    url_data=[dict(url='http://example.com/%d' % i, label='link %d' % i) for i in range(3)]
+)
+
+
+def benchmark(f):
+    benchmarks[f.__name__] = f
+    return f
+
+
+def _render(names):
+    templates = [Template(T, root=os.path.join(_templates, name)) for name in names]
+
+    def render():
+        for t in templates:
+            t.render('index', _params, namespace='v')
+    return render
+
+
+@benchmark
+def compile_templates():
+    """compiling the test templates into bytecode, without caching"""
+    loader = FileLoader()
+    sources = [(name, os.path.join(_templates, name)) for name in _test_templates]
+
+    def compile_all():
+        cache = Cache()
+        for _name, root in sources:
+            cache.compile('index.b', root, loader)
+    return compile_all
+
+
+@benchmark
+def render_templates():
+    """rendering the test templates"""
+    return _render(_test_templates)
+
+
+@benchmark
+def inheritance():
+    """rendering templates using inherits, override and slot"""
+    return _render(['test_simple_inheritance', 'test_nested_inheritance',
+                    'test_macros_inside_inherits'])
+
+
+@benchmark
+def flat_list():
+    """building and flattening a list of 10000 items"""
+    return lambda: flatten(T.ul[[T.li(class_='item')[str(i)] for i in range(10000)]])
+
+
+@benchmark
+def deep_nesting():
+    """building and flattening 2000 nested tags"""
+    def nest():
+        doc = 'bottom'
+        for _i in range(2000):
+            doc = T.div[doc]
+        return flatten(doc)
+    return nest
+
+
+@benchmark
+def mul_table():
+    """a 5000-row table from tag multiplication"""
+    rows = [dict(id=i, name='row %d' % i, price='%.2f' % (i * 1.5)) for i in range(5000)]
+    row = T.tr(id='row-$id')[T.td['$name'], T.td['$price']]
+    return lambda: flatten(T.table[row * rows])
+
+
+@benchmark
+def escape_heavy():
+    """flattening text with lots of characters to escape"""
+    text = ['<a href="x?a=1&b=%d">"quoted" & <b>bold</b></a>' % i for i in range(5000)]
+    plain = ['nothing to escape in item %d' % i for i in range(5000)]
+
+    def escape_all():
+        for s in text:
+            escape(s)
+        for s in plain:
+            escape(s)
+        flatten(T.div[text])
+    return escape_all
+
+
+@benchmark
+def minify_js():
+    """jsmin on about 30kB of javascript"""
+    js = ''.join(
+        '// function %d\nfunction f%d ( a, b ) {\n    var c = a + b ;  /* sum */\n'
+        '    return c * %d ;\n}\n' % (i, i, i)
+        for i in range(300)
+    )
+    return lambda: jsmin(js)
+
+
+def run(names=None, number=10, repeat=3):
+    """runs the named benchmarks (all by default), returns the results as a dict"""
+    results = {}
+    for name in names or sorted(benchmarks):
+        f = benchmarks[name]()
+        f()  # warm up the caches
+        times = [t / number for t in timeit.Timer(f).repeat(repeat, number)]
+        results[name] = dict(
+            doc=benchmarks[name].__doc__,
+            number=number,
+            repeat=repeat,
+            best=min(times),
+            mean=sum(times) / len(times),
+        )
+    return dict(
+        breve=breve.__version__,
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        platform=sys.platform,
+        benchmarks=results,
+    )
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import sys
+
+from breve.benchmarks import benchmarks, run
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m breve.benchmarks',
+                                     description='run the breve benchmarks, print JSON')
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='benchmarks to run (default: all of %s)' % ', '.join(sorted(benchmarks)))
+    parser.add_argument('-n', '--number', type=int, default=10, help='calls per timing')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='number of timings')
+    parser.add_argument('-o', '--output', help='write the results to this file')
+    args = parser.parse_args(argv)
+
+    unknown = [n for n in args.names if n not in benchmarks]
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(unknown))
+
+    results = json.dumps(run(args.names, args.number, args.repeat), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results + '\n')
+    else:
+        sys.stdout.write(results + '\n')
+
+
+if __name__ == '__main__':
+    main()
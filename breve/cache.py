@@ -1,20 +1,282 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import marshal
+import os
+import pickle
+import sqlite3
+import sys
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from importlib.util import MAGIC_NUMBER
 from time import time
 
 
+class Watcher(threading.Thread):
+    """background thread that re-checks the templates a cache has seen"""
+
+    def __init__(self, cache, interval):
+        threading.Thread.__init__(self, name='breve-watcher', daemon=True)
+        self.cache = cache
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.cache.refresh()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class CacheBackend(ABC):
+    """
+    interface of the stores behind Cache.memoize and the cache()
+    directive.  A ttl of None means the entry doesn't expire.
+    """
+
+    @abstractmethod
+    def get(self, key, default=None):
+        pass
+
+    @abstractmethod
+    def set(self, key, value, ttl=None):
+        pass
+
+    @abstractmethod
+    def invalidate(self, key):
+        pass
+
+    @abstractmethod
+    def invalidate_prefix(self, prefix):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    @abstractmethod
+    def stats(self):
+        pass
+
+
+class LRUCache(CacheBackend):
+    """
+    Bounded, thread-safe in-process key/value store.  Entries expire after their
+    ttl (seconds, None for never) and the least recently used ones are
+    evicted once there are more than max_entries of them or their total
+    size (as measured by sizeof) exceeds max_bytes.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None, sizeof=sys.getsizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.entries = OrderedDict()  # key -> (value, expires, size)
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and (entry[1] is None or entry[1] > time())
+
+    def _remove(self, key):
+        _value, _expires, size = self.entries.pop(key)
+        self.bytes -= size
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] is None or entry[1] > time():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            expires = None if ttl is None else time() + ttl
+            self.entries[key] = (value, expires, size)
+            self.bytes += size
+            while ((self.max_entries is not None and len(self.entries) > self.max_entries) or
+                   (self.max_bytes is not None and self.bytes > self.max_bytes)):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def invalidate_prefix(self, prefix):
+        with self.lock:
+            for key in [k for k in self.entries
+                        if isinstance(k, str) and k.startswith(prefix)]:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return dict(
+            entries=len(self.entries),
+            bytes=self.bytes,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions
+        )
+
+
+class SQLiteCache(CacheBackend):
+    """
+    Key/value store in an SQLite database file, shared by every process
+    (and thread) using the same path, so that a fragment rendered by one
+    worker is served by all of them.  Keys must be strings and values
+    picklable.  Least recently used entries are evicted once there are
+    more than max_entries; hit, miss and eviction counts are per process.
+    """
+
+    def __init__(self, path, max_entries=None, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self.local = threading.local()
+
+    def _db(self):
+        # connections can neither be shared between threads nor survive a fork
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS fragments '
+                       '(key TEXT PRIMARY KEY, value BLOB, expires REAL, used REAL)')
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def __len__(self):
+        return self._db().execute('SELECT COUNT(*) FROM fragments').fetchone()[0]
+
+    def __contains__(self, key):
+        return self._db().execute(
+            'SELECT 1 FROM fragments WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, time())).fetchone() is not None
+
+    def get(self, key, default=None):
+        db = self._db()
+        now = time()
+        row = db.execute('SELECT value, expires FROM fragments WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            if row[1] is None or row[1] > now:
+                db.execute('UPDATE fragments SET used = ? WHERE key = ?', (now, key))
+                self.hits += 1
+                return pickle.loads(row[0])
+            db.execute('DELETE FROM fragments WHERE key = ? AND expires <= ?', (key, now))
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        db = self._db()
+        now = time()
+        expires = None if ttl is None else now + ttl
+        db.execute('INSERT OR REPLACE INTO fragments VALUES (?, ?, ?, ?)',
+                   (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires, now))
+        if self.max_entries is not None:
+            evicted = db.execute('DELETE FROM fragments WHERE key NOT IN '
+                                 '(SELECT key FROM fragments ORDER BY used DESC LIMIT ?)',
+                                 (self.max_entries,)).rowcount
+            self.evictions += max(evicted, 0)
+
+    def invalidate(self, key):
+        self._db().execute('DELETE FROM fragments WHERE key = ?', (key,))
+
+    def invalidate_prefix(self, prefix):
+        self._db().execute('DELETE FROM fragments WHERE substr(key, 1, ?) = ?',
+                           (len(prefix), prefix))
+
+    def clear(self):
+        self._db().execute('DELETE FROM fragments')
+
+    def stats(self):
+        entries, size = self._db().execute(
+            'SELECT COUNT(*), TOTAL(length(value)) FROM fragments').fetchone()
+        return dict(
+            entries=entries,
+            bytes=int(size),
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions
+        )
+
+
 class Cache(object):
-    __slots__ = ['ccache', 'scache', 'loader']
+    __slots__ = ['ccache', 'scache', 'stats', 'loader']
 
-    def __init__(self):
+    def __init__(self, max_entries=None, max_bytes=None, backend=None):
         self.ccache = {}
-        self.scache = {}
-
-    def compile(self, template, root, loader):
-        uid, timestamp = loader.stat(template, root)
-        if uid in self.ccache:
-            if timestamp == self.ccache[uid]['timestamp']:
-                return self.ccache[uid]['bytecode']
-        to_compile = loader.load(uid)
+        # store for memoize(), any CacheBackend
+        self.scache = backend if backend is not None else LRUCache(max_entries, max_bytes)
+        self.stats = {}
+
+    def stat(self, template, root, loader, check_interval=0):
+        """
+        loader.stat(), unless the template was checked less than
+        check_interval seconds ago.  With a check_interval of None a
+        template is checked once and afterwards only by refresh(),
+        e.g. from a watch() thread.
+        """
+        if check_interval == 0:
+            return loader.stat(template, root)
+        key = (template, root, loader)
+        entry = self.stats.get(key)
+        now = time()
+        if entry is None or (check_interval is not None and now - entry[2] >= check_interval):
+            uid, timestamp = loader.stat(template, root)
+            entry = self.stats[key] = (uid, timestamp, now)
+        return entry[0], entry[1]
+
+    def refresh(self):
+        """re-check every template remembered by stat()"""
+        for key, entry in list(self.stats.items()):
+            template, root, loader = key
+            try:
+                uid, timestamp = loader.stat(template, root)
+            except OSError:
+                self.stats.pop(key, None)
+                continue
+            if timestamp != entry[1]:
+                self.stats[key] = (uid, timestamp, time())
+
+    def watch(self, interval=1.0):
+        """start and return a Watcher thread calling refresh() every interval seconds"""
+        watcher = Watcher(self, interval)
+        watcher.start()
+        return watcher
+
+    def prepare(self, to_compile):
+        """wrap template source in brackets so it compiles as one expression"""
         if to_compile[:1] == "#":
             # Skip lines that start with a comment, so that for example
             # encoding information is left intact. Putting a newline after
@@ -35,27 +297,102 @@ class Cache(object):
             # put the container brackets in front and at the end. This will
             # not change the line number information in error messages.
             to_compile = "(" + to_compile + "\n)"
-        self.ccache[uid] = dict(
+        return to_compile
+
+    def _disk_path(self, cache_dir, uid):
+        return os.path.join(cache_dir, hashlib.sha1(str(uid).encode('utf-8')).hexdigest() + '.bc')
+
+    def _disk_load(self, cache_dir, uid, timestamp, size):
+        try:
+            with open(self._disk_path(cache_dir, uid), 'rb') as f:
+                data = f.read()
+            if data[:len(MAGIC_NUMBER)] != MAGIC_NUMBER:
+                return None
+            _uid, _timestamp, _size, bytecode = marshal.loads(data[len(MAGIC_NUMBER):])
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if (_uid, _timestamp, _size) != (uid, timestamp, size):
+            return None
+        return bytecode
+
+    def _disk_store(self, cache_dir, uid, timestamp, size, bytecode):
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(MAGIC_NUMBER)
+                    marshal.dump((uid, timestamp, size, bytecode), f)
+                # atomic, so concurrent workers never see a partial file
+                os.replace(tmp, self._disk_path(cache_dir, uid))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except (OSError, ValueError):
+            pass  # the cache is an optimization only
+
+    def _disk_compile(self, cache_dir, template, uid, timestamp, loader):
+        try:
+            size = os.stat(uid).st_size
+        except (OSError, TypeError, ValueError):
+            size = None  # not a file, the loader's timestamp has to do
+        bytecode = self._disk_load(cache_dir, uid, timestamp, size)
+        if bytecode is None:
+            bytecode = compile(self.prepare(loader.load(uid)), template, 'eval')
+            self._disk_store(cache_dir, uid, timestamp, size, bytecode)
+        return bytecode
+
+    def _compile(self, template, root, loader, compiler=None, cache_dir=None, check_interval=0):
+        uid, timestamp = self.stat(template, root, loader, check_interval)
+        key = uid if compiler is None else (uid, compiler.key)
+        if key in self.ccache:
+            if timestamp == self.ccache[key]['timestamp']:
+                return self.ccache[key]
+        if compiler is not None:
+            bytecode, names = compiler.compile(self.prepare(loader.load(uid)), template)
+        elif cache_dir:
+            bytecode, names = self._disk_compile(cache_dir, template, uid, timestamp, loader), frozenset()
+        else:
+            bytecode, names = compile(self.prepare(loader.load(uid)), template, 'eval'), frozenset()
+        self.ccache[key] = dict(
             timestamp=timestamp,
-            bytecode=compile(to_compile, template, 'eval')
+            bytecode=bytecode,
+            names=names
         )
-        return self.ccache[uid]['bytecode']
+        return self.ccache[key]
+
+    def compile(self, template, root, loader, cache_dir=None, check_interval=0):
+        """
+        returns the bytecode for template.  If cache_dir is given, the
+        bytecode is also kept there across processes (like __pycache__),
+        keyed by the template's path, timestamp, size and the Python
+        bytecode version.  See stat() for check_interval.
+        """
+        return self._compile(template, root, loader, cache_dir=cache_dir,
+                             check_interval=check_interval)['bytecode']
+
+    def compile_static(self, template, root, loader, compiler, check_interval=0):
+        """
+        returns the bytecode with static subtrees folded by compiler
+        (see breve.compiler) and the tag names the folding relies on
+        """
+        entry = self._compile(template, root, loader, compiler, check_interval=check_interval)
+        return entry['bytecode'], entry['names']
 
     def get_fragment(self, template, fragment, root):
         uid, _timestamp = self.loader.stat(template, root)
         return self.ccache[uid]['bytecode']
 
     def memoize(self, id, timeout, f, *args, **kw):  # @ReservedAssignment
-        t = time()
-        if id not in self.scache:
-            self.scache[id] = {
-                'timestamp': t,
-                'string': f(*args, **kw)
-            }
-        elif (t - self.scache[id]['timestamp']) > timeout:
-            self.scache[id] = {
-                'timestamp': t,
-                'string': f(*args, **kw)
-            }
-
-        return self.scache[id]['string']
+        """
+        returns f(*args, **kw), computed at most once every timeout
+        seconds for the same id.  Results live in scache (an LRUCache
+        unless another backend was given), so its limits, invalidate()
+        and stats() apply.
+        """
+        missing = self.scache  # never a cached value
+        result = self.scache.get(id, missing)
+        if result is missing:
+            result = f(*args, **kw)
+            self.scache.set(id, result, timeout)
+        return result
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+optional compiler stage that folds the static parts of a template
+(tags with literal attributes and literal children) into pre-flattened
+markup so they needn't be rebuilt and flattened on every render.
+"""
+import ast
+
+from breve.flatten import flatten
+from breve.tags import Proto
+from breve.tags.entities import Entity
+from breve.tags.html import HtmlProto
+from breve.util import Namespace
+
+# name under which the templates expect the markup class (xml)
+STATIC = '__static__'
+
+_literals = (str, int, float)
+
+
+class StaticCompiler(object):
+    """
+    Compiles template source to bytecode, replacing every static subtree
+    that is only used as template output (i.e. not passed to a macro or
+    function, or given a renderer) with a constant __static__(markup).
+
+    Folding assumes that the tag names it folded aren't rebound while
+    rendering; compile() returns those names so that callers can fall
+    back to the unfolded bytecode when a parameter shadows one of them.
+    Names the template rebinds itself, via assign() or macro(), are never
+    folded, and neither is a subtree that fails to evaluate at compile
+    time (it fails, or not, when rendered instead).
+    """
+    __slots__ = ['tags', 'key']
+
+    def __init__(self, tags):
+        self.tags = tags
+        # templates compiled against the same tag definitions can share
+        # their folded bytecode
+        self.key = frozenset(
+            (k, type(v), v if isinstance(v, str) else id(v))
+            for k, v in tags.items()
+            if isinstance(v, (Proto, HtmlProto, Entity, Namespace))
+        )
+
+    def compile(self, source, filename):
+        tree = ast.parse(source, filename, 'eval')
+        names = set()
+        tree.body = self._fold_output(tree.body, names, _rebound(tree))
+        ast.fix_missing_locations(tree)
+        return compile(tree, filename, 'eval'), frozenset(names)
+
+    def _is_tag(self, node, rebound):
+        if isinstance(node, ast.Name):
+            return node.id not in rebound and \
+                isinstance(self.tags.get(node.id), (Proto, HtmlProto, Entity))
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            if node.value.id in rebound:
+                return False
+            ns = self.tags.get(node.value.id)
+            return isinstance(ns, Namespace) and node.attr in ns and \
+                isinstance(ns[node.attr], Entity)
+        return False
+
+    def _is_static(self, node, rebound):
+        """a tag or entity whose attributes and children are all literals"""
+        if self._is_tag(node, rebound):
+            return True
+        if isinstance(node, ast.Call):
+            return (self._is_tag(node.func, rebound) and
+                    all(isinstance(a, ast.Constant) and isinstance(a.value, _literals)
+                        for a in node.args) and
+                    all(k.arg not in (None, 'render', 'data') and
+                        isinstance(k.value, ast.Constant) and isinstance(k.value.value, _literals)
+                        for k in node.keywords))
+        if isinstance(node, ast.Subscript):
+            return self._is_static(node.value, rebound) and \
+                self._is_static_child(node.slice, rebound)
+        return False
+
+    def _is_static_child(self, node, rebound):
+        if isinstance(node, (ast.Tuple, ast.List)):
+            return all(self._is_static_child(e, rebound) for e in node.elts)
+        if isinstance(node, ast.Constant):
+            return isinstance(node.value, _literals)
+        return self._is_static(node, rebound)
+
+    def _is_output_head(self, node, rebound):
+        """the children of this tag end up in the output unaltered"""
+        if isinstance(node, ast.Call):
+            if any(k.arg in (None, 'render', 'data') for k in node.keywords):
+                return False
+            node = node.func
+        return isinstance(node, ast.Name) and node.id in self.tags and node.id not in rebound
+
+    def _fold(self, node, names):
+        expr = ast.Expression(node)
+        ast.fix_missing_locations(expr)
+        try:
+            markup = flatten(eval(compile(expr, '<static>', 'eval'), dict(self.tags)))
+        except Exception:
+            return node
+        names.update(n.id for n in ast.walk(node) if isinstance(n, ast.Name))
+        return ast.copy_location(
+            ast.Call(func=ast.Name(id=STATIC, ctx=ast.Load()),
+                     args=[ast.Constant(value=markup)],
+                     keywords=[]),
+            node
+        )
+
+    def _fold_output(self, node, names, rebound):
+        """fold static subtrees of an expression whose value is output as is"""
+        if self._is_static(node, rebound):
+            return self._fold(node, names)
+        if isinstance(node, (ast.Tuple, ast.List)):
+            node.elts = [self._fold_output(e, names, rebound) for e in node.elts]
+        elif isinstance(node, ast.Subscript):
+            if self._is_output_head(node.value, rebound):
+                node.slice = self._fold_output(node.slice, names, rebound)
+        elif isinstance(node, ast.BoolOp):
+            node.values = [self._fold_output(v, names, rebound) for v in node.values]
+        elif isinstance(node, ast.IfExp):
+            node.body = self._fold_output(node.body, names, rebound)
+            node.orelse = self._fold_output(node.orelse, names, rebound)
+        return node
+
+
+def _rebound(tree):
+    """the names a template binds itself, with assign('name', ...) or macro('name', ...)"""
+    return frozenset(
+        node.args[0].value for node in ast.walk(tree)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+        node.func.id in ('assign', 'macro') and node.args and
+        isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str)
+    )
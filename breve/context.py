@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+per-render state, kept in a context variable so that renders running
+concurrently in threads or asyncio tasks don't see each other's state
+"""
+import threading
+from concurrent.futures import Future
+from contextvars import ContextVar
+
+from breve.util import Namespace
+
+_current = ContextVar('breve_render_context', default=None)
+
+
+class RenderContext(object):
+    __slots__ = ['template', 'params', 'fragments', 'render_path', 'loaders', 'stacks',
+                 'includes', 'data', 'rendered', 'preamble', 'options', 'lock']
+
+    def __init__(self, template=None, loaders=()):
+        self.template = template
+        self.params = Namespace({'xmlns': getattr(template, 'xmlns', None)})
+        self.fragments = {}
+        self.render_path = []
+        self.loaders = list(loaders)
+        self.stacks = {}
+        # bytecode of the fragments included so far
+        self.includes = {}
+        # values of lazy data providers and results of tag renderers,
+        # computed once per render (see breve.tags.Lazy and once())
+        self.data = {}
+        self.rendered = {}
+        # template options set by preamble()
+        self.preamble = {}
+        # template options given to the render method
+        self.options = {}
+        self.lock = threading.Lock()
+
+    def child(self):
+        """
+        a context for flattening part of this render in another thread:
+        it has its own parameters, fragments, loaders and render path,
+        and shares the stacks and the values computed once per render
+        """
+        ctx = RenderContext.__new__(RenderContext)
+        ctx.template = self.template
+        ctx.params = Namespace(self.params._dict)
+        ctx.fragments = dict(self.fragments)
+        ctx.render_path = list(self.render_path)
+        ctx.loaders = list(self.loaders)
+        ctx.stacks = self.stacks
+        ctx.includes = dict(self.includes)
+        ctx.data = self.data
+        ctx.rendered = self.rendered
+        ctx.preamble = dict(self.preamble)
+        ctx.options = dict(self.options)
+        ctx.lock = self.lock
+        return ctx
+
+    def once(self, table, key, compute):
+        """
+        the value of compute() for key in table (data or rendered), which
+        is computed by the first thread asking for it while the others,
+        flattening the same render, wait for it
+        """
+        with self.lock:
+            future = table.get(key)
+            first = future is None
+            if first:
+                future = table[key] = Future()
+        if first:
+            try:
+                future.set_result(compute())
+            except BaseException as e:
+                # the next to ask tries again
+                with self.lock:
+                    del table[key]
+                future.set_exception(e)
+                raise
+        return future.result()
+
+
+def current_context():
+    """the active render context, None outside of renders"""
+    return _current.get()
+
+
+def enter_context(template):
+    """
+    returns the active render context of template and None, or, if
+    there is none, a new active context and the token to reset it with
+    """
+    ctx = _current.get()
+    if ctx is not None and ctx.template is template:
+        return ctx, None
+    ctx = RenderContext(template, template.loaders)
+    return ctx, _current.set(ctx)
+
+
+def activate_context(ctx):
+    """makes ctx the active render context of the current context"""
+    return _current.set(ctx)
+
+
+def exit_context(token):
+    if token is not None:
+        _current.reset(token)
+
+
+# namespace of the template being evaluated, for include()
+_namespace = ContextVar('breve_namespace', default=None)
+
+
+def current_namespace():
+    """the globals of the template being evaluated, None while flattening"""
+    return _namespace.get()
+
+
+def enter_namespace(namespace):
+    return _namespace.set(namespace)
+
+
+def exit_namespace(token):
+    _namespace.reset(token)
+
+
+# state for push() and pop() outside of renders
+_idle = ContextVar('breve_idle_context', default=None)
+
+
+def stacks():
+    ctx = _current.get()
+    if ctx is None:
+        ctx = _idle.get()
+        if ctx is None:
+            ctx = RenderContext()
+            _idle.set(ctx)
+    return ctx.stacks
+
+
+# the profiler recording renders in this context, see breve.profiler
+_profiler = ContextVar('breve_profiler', default=None)
+
+
+def current_profiler():
+    return _profiler.get()
@@ -1,12 +1,55 @@
 # -*- coding: utf-8 -*-
+import asyncio
+from concurrent.futures import Future
+
+from breve.context import current_profiler
+
 #
 # registry of flatteners
 #
 __registry = {}
 
+#
+# registry of expanders: types whose output is made up of other
+# objects (tags, sequences, ...) can register a function returning
+# those objects in order so that flatten_iter can walk them lazily
+#
+__expanders = {}
 
-def register_flattener(o, f):
+#
+# flatteners registered with writer=True, which are called as f(o, write)
+# and pass their output to write() rather than returning it
+#
+__writers = set()
+
+#
+# flattener, and (flattener, expander, writer) triple, resolved for
+# every type seen so far
+#
+__resolved = {}
+__resolved_entries = {}
+
+
+def _invalidate():
+    __resolved.clear()
+    __resolved_entries.clear()
+
+
+def register_flattener(o, f, writer=False):
+    """
+    register f to flatten objects of type o: f(obj) returns a string or,
+    if writer is true, f(obj, write) passes strings to write(), so that
+    nested output goes straight to the buffer of the whole render (use
+    flatten_to(child, write) for children).
+    """
     __registry[o] = f
+    if writer:
+        __writers.add(o)
+    else:
+        __writers.discard(o)
+    # a new flattener replaces any expansion registered for the type
+    __expanders.pop(o, None)
+    _invalidate()
 
 
 def unregister_flattener(o):
@@ -14,6 +57,22 @@ def unregister_flattener(o):
         del __registry[o]
     except KeyError:
         pass
+    __writers.discard(o)
+    __expanders.pop(o, None)
+    _invalidate()
+
+
+def register_expander(o, f):
+    __expanders[o] = f
+    _invalidate()
+
+
+def unregister_expander(o):
+    try:
+        del __expanders[o]
+    except KeyError:
+        pass
+    _invalidate()
 
 
 def registry():
@@ -25,8 +84,308 @@ def get_registered_flattener(o):
     return __registry[o]
 
 
+def _written(writer):
+    def flatten_written(o):
+        buf = []
+        writer(o, buf.append)
+        return u''.join(buf)
+    return flatten_written
+
+
+def _resolve(t):
+    f, e, w = str, None, None
+    for c in t.__mro__:
+        if c in __registry:
+            f, e = __registry[c], __expanders.get(c)
+            if c in __writers:
+                f, w = _written(f), f
+            break
+        if '__str__' in c.__dict__:
+            break
+    if len(__resolved) > 1024:
+        # types created on the fly (e.g. per template) mustn't pile up
+        _invalidate()
+    __resolved[t] = f
+    __resolved_entries[t] = f, e, w
+    return f, e, w
+
+
+def resolve(t):
+    """
+    returns the flattener for type t: the one registered for the closest
+    class in its MRO, or str if a class before that overrides __str__
+    (or none is registered at all).  Results are cached per type.
+    """
+    return _resolve(t)[0]
+
+
 def flatten(o):
-    try:
-        return __registry[type(o)](o)
-    except KeyError:
-        return str(o)
+    f = __resolved.get(type(o))
+    if f is None:
+        f = resolve(type(o))
+    return f(o)
+
+
+def _counted(write, written):
+    """write(), adding the length of the output to written[0]"""
+    def counted(s):
+        written[0] += len(s)
+        write(s)
+    return counted
+
+
+def _measured(profiler, marks, depth, written):
+    """records the output size of the measured object expanded at depth, if any"""
+    if marks and marks[-1][0] == depth:
+        _depth, (kind, name), start = marks.pop()
+        profiler.record(kind, name, 0.0, written[0] - start, 0)
+
+
+def _chunks(parts, bufsize=None, write=None):
+    """
+    the flattening engine: walks parts, and the expansions of their
+    items, depth-first with an explicit stack of iterators rather than
+    recursion, so documents can nest arbitrarily deep.  Flattened pieces
+    go to write() if given, else to a buffer which is yielded whenever
+    it holds bufsize characters, or only once at the end if bufsize is
+    None.
+    """
+    resolved = __resolved_entries
+    profiler = current_profiler()
+    buf = []
+    own = write is None
+    if own:
+        write = buf.append
+    if profiler is not None:
+        # output written so far, and (stack depth, key, output written
+        # before) of the expanded objects the profiler measures
+        written, marks = [0], []
+        write = _counted(write, written)
+    size = 0
+    stack = [iter(parts)]
+    while stack:
+        for c in stack[-1]:
+            entry = resolved.get(type(c))
+            if entry is None:
+                entry = _resolve(type(c))
+            measured = None
+            if profiler is not None:
+                entry = profiler.instrument(type(c), entry)
+                measured = profiler.measured(c)
+            f, expand, writer = entry
+            if expand is not None:
+                stack.append(iter(expand(c)))
+                if measured is not None:
+                    marks.append((len(stack), measured, written[0]))
+                break
+            if measured is not None:
+                start = written[0]
+            if writer is None:
+                s = f(c)
+                write(s)
+                if bufsize is not None:
+                    size += len(s)
+            else:
+                n = len(buf)
+                writer(c, write)
+                if bufsize is not None:
+                    size += sum(map(len, buf[n:]))
+            if measured is not None:
+                profiler.record(measured[0], measured[1], 0.0, written[0] - start, 0)
+            if bufsize is not None and size >= bufsize:
+                yield u''.join(buf)
+                del buf[:]
+                size = 0
+        else:
+            if profiler is not None:
+                _measured(profiler, marks, len(stack), written)
+            stack.pop()
+    if own and (bufsize is None or size):
+        yield u''.join(buf)
+
+
+def flatten_expanded(parts):
+    """flattens the parts returned by an expander into one string"""
+    return next(_chunks(parts))
+
+
+def flatten_to(o, write):
+    """flattens o by passing its output piece by piece to write()"""
+    for _chunk in _chunks((o,), write=write):
+        pass
+
+
+def flatten_iter(o, bufsize=8192):
+    """
+    generator that yields the flattened output of o in chunks of at
+    least bufsize characters (the last one may be shorter).  If bufsize
+    is 0 or None every piece is yielded as soon as it is produced.
+    """
+    return _chunks((o,), bufsize or 1)
+
+
+#
+# flatteners for the asynchronous engine: coroutine functions returning
+# a string, awaited instead of the flattener of the same type, for types
+# whose output is made of other objects that may need awaiting
+#
+__async_registry = {}
+
+#
+# how the asynchronous engine treats every type seen so far, as a
+# (kind, async flattener) pair
+#
+_PLAIN, _AWAIT, _AITER, _AFLATTEN = 0, 1, 2, 3
+__async_kinds = {}
+
+
+def register_async_flattener(o, f):
+    __async_registry[o] = f
+    __async_kinds.clear()
+
+
+def unregister_async_flattener(o):
+    __async_registry.pop(o, None)
+    __async_kinds.clear()
+
+
+def _async_kind(t):
+    entry = __async_kinds.get(t)
+    if entry is None:
+        for c in t.__mro__:
+            if c in __async_registry:
+                entry = _AFLATTEN, __async_registry[c]
+                break
+        else:
+            if issubclass(t, Future) or hasattr(t, '__await__'):
+                entry = _AWAIT, None
+            elif hasattr(t, '__aiter__'):
+                entry = _AITER, None
+            else:
+                entry = _PLAIN, None
+        if len(__async_kinds) > 1024:
+            __async_kinds.clear()
+        __async_kinds[t] = entry
+    return entry
+
+
+def _future(o):
+    if isinstance(o, Future):
+        return asyncio.wrap_future(o)
+    return asyncio.ensure_future(o)
+
+
+def _started(parts):
+    """the parts, with the awaitables among them already running"""
+    parts = list(parts)
+    for i, c in enumerate(parts):
+        if _async_kind(type(c))[0] is _AWAIT:
+            parts[i] = _future(c)
+    return iter(parts)
+
+
+async def _achunks(parts, bufsize=None):
+    """
+    the asynchronous variant of _chunks: awaitables (coroutines, futures)
+    in the tree are awaited and flattened in their place, and async
+    iterables are iterated.  The awaitables among the children of a tag
+    or sequence are all started when it is expanded, so that they run
+    concurrently.
+
+    Other flatteners, writers included, run synchronously, so types
+    producing their output from objects that may need awaiting (like
+    the cache() directive) need an async flattener as well, see
+    register_async_flattener().
+    """
+    resolved = __resolved_entries
+    profiler = current_profiler()
+    buf = []
+    write = buf.append
+    if profiler is not None:
+        written, marks = [0], []
+        write = _counted(write, written)
+    size = 0
+    stack = [(_started(parts), False)]
+    done = object()
+    while stack:
+        it, is_async = stack[-1]
+        if is_async:
+            try:
+                c = await it.__anext__()
+            except StopAsyncIteration:
+                if profiler is not None:
+                    _measured(profiler, marks, len(stack), written)
+                stack.pop()
+                continue
+        else:
+            c = next(it, done)
+            if c is done:
+                if profiler is not None:
+                    _measured(profiler, marks, len(stack), written)
+                stack.pop()
+                continue
+        measured = None
+        if profiler is not None:
+            measured = profiler.measured(c)
+        kind, aflatten = _async_kind(type(c))
+        while kind is _AWAIT:
+            c = await _future(c)
+            kind, aflatten = _async_kind(type(c))
+        if kind is _AITER:
+            stack.append((c.__aiter__(), True))
+            if measured is not None:
+                marks.append((len(stack), measured, written[0]))
+            continue
+        n = len(buf)
+        if measured is not None:
+            start = written[0]
+        if kind is _AFLATTEN:
+            write(await aflatten(c))
+            if measured is not None:
+                profiler.record(measured[0], measured[1], 0.0, written[0] - start, 0)
+            if bufsize is not None:
+                size += len(buf[-1])
+                if size >= bufsize:
+                    yield u''.join(buf)
+                    del buf[:]
+                    size = 0
+            continue
+        entry = resolved.get(type(c))
+        if entry is None:
+            entry = _resolve(type(c))
+        if profiler is not None:
+            entry = profiler.instrument(type(c), entry)
+        f, expand, writer = entry
+        if expand is not None:
+            stack.append((_started(expand(c)), False))
+            if measured is not None:
+                marks.append((len(stack), measured, written[0]))
+            continue
+        if writer is None:
+            write(f(c))
+        else:
+            writer(c, write)
+        if measured is not None:
+            profiler.record(measured[0], measured[1], 0.0, written[0] - start, 0)
+        if bufsize is not None:
+            size += sum(map(len, buf[n:]))
+            if size >= bufsize:
+                yield u''.join(buf)
+                del buf[:]
+                size = 0
+    if bufsize is None or size:
+        yield u''.join(buf)
+
+
+def aflatten_iter(o, bufsize=8192):
+    """
+    async generator yielding the flattened output of o, awaiting the
+    awaitables and iterating the async iterables in it, in chunks of at
+    least bufsize characters (the last one may be shorter)
+    """
+    return _achunks((o,), bufsize or 1)
+
+
+async def aflatten(o):
+    """flattens o into one string, awaiting the awaitables in it"""
+    return u''.join([s async for s in _achunks((o,))])
@@ -1,33 +1,49 @@
 # -*- coding: utf-8 -*-
+from breve.context import stacks
+
 __globals = {}
+__version = 0  # bumped on every change so namespaces built from the globals can be reused
 
 
 def register_global(k, v):
+    global __version
     __globals[k] = v
+    __version += 1
 
 
 def register_globals(d):
+    global __version
     __globals.update(d)
+    __version += 1
 
 
 def unregister_global(k):
+    global __version
     try:
         del __globals[k]
     except KeyError:
         return
+    __version += 1
 
 
 def unregister_globals():
+    global __version
     __globals.clear()
+    __version += 1
 
 
 def get_globals():
     return __globals
 
-__stacks = {}
+
+def get_globals_version():
+    return __version
+
+# stacks belong to the current render (see breve.context)
 
 
 def push(**kw):
+    __stacks = stacks()
     for k, v in kw.items():
         if not k in __stacks:
             __stacks[k] = []
@@ -36,6 +52,7 @@ def push(**kw):
 
 
 def pop(key):
+    __stacks = stacks()
     result = __stacks[key].pop()
     if not (__stacks[key]):
         del __stacks[key]
@@ -44,9 +61,9 @@ def pop(key):
 
 def get_stack(stack):
     """mostly for debugging"""
-    return __stacks[stack]
+    return stacks()[stack]
 
 
 def get_stacks():
     """mostly for debugging"""
-    return __stacks
+    return stacks()
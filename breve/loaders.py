@@ -11,4 +11,4 @@ class FileLoader(object):
         return uid, timestamp
 
     def load(self, uid):
-        return open(uid, 'U').read()
+        return open(uid).read()
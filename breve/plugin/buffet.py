@@ -2,7 +2,7 @@
 import os
 from urllib.parse import splitquery
 
-from breve import Template
+from breve.plugin.helpers import get_template
 from breve.tags import html
 
 
@@ -107,9 +107,9 @@ class BreveTemplatePlugin(object):
             self.tag_defs[format] = __import__(format, {}, {})
 
         self.breve_opts['doctype'] = self.breve_opts.get('doctype', self.tag_defs[format].doctype)
-        template_obj = Template(tags=self.tag_defs[format].tags,
-                                xmlns=self.tag_defs[format].xmlns,
-                                **self.breve_opts)
+        template_obj = get_template(self.tag_defs[format].tags,
+                                    xmlns=self.tag_defs[format].xmlns,
+                                    **self.breve_opts)
 
         if fragment:
             return template_obj.render_partial(os.path.join(template_path, template_filename),
@@ -4,7 +4,7 @@ from django.http import HttpResponse
 from django.template import Context, TemplateDoesNotExist
 from django.utils.translation import gettext_lazy as _
 
-from breve import Template
+from breve.plugin.helpers import get_template
 from breve.tags import html
 
 BREVE_ROOT = settings.BREVE_ROOT
@@ -46,7 +46,7 @@ class TemplateAdapter(object):
     """
 
     def __init__(self, names, root=BREVE_ROOT, breve_opts={}):
-        self.template = Template(tags=html.tags, root=root, **breve_opts)
+        self.template = get_template(html.tags, root=root, **breve_opts)
         self.names = names
         self.breve_opts = breve_opts
 
@@ -1,7 +1,47 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+
 from breve import Template
 from breve.tags.html import tags
 
+# the most recently used templates by configuration, see get_template()
+_templates = OrderedDict()
+_max_templates = 64
+
+
+def get_template(tags, root='.', xmlns=None, doctype=None, **kw):
+    """
+    returns a Template configured with these arguments, shared by every
+    caller passing the same ones.  Per-render state, including options
+    given to render() or set by preamble(), lives in a render context
+    (see breve.context), so one pooled template can serve any number of
+    requests, including concurrent ones.
+
+    Templates are pooled by the identity of tags, which should be a
+    long-lived (e.g. module-level) dict; the pool keeps the most
+    recently used _max_templates configurations.
+    """
+    try:
+        key = (id(tags), root, xmlns, doctype, tuple(sorted(kw.items())))
+        hash(key)
+    except TypeError:
+        return Template(tags, root=root, xmlns=xmlns, doctype=doctype, **kw)
+    try:
+        t = _templates[key][1]
+    except KeyError:
+        t = Template(tags, root=root, xmlns=xmlns, doctype=doctype, **kw)
+        # keep tags alive so that its id can't be reused
+        t = _templates.setdefault(key, (tags, t))[1]
+        while len(_templates) > _max_templates:
+            _templates.popitem(last=False)
+        return t
+    try:
+        _templates.move_to_end(key)
+    except KeyError:
+        # evicted by another thread meanwhile
+        pass
+    return t
+
 
 def render_decorator(template, **template_kw):
     """
@@ -10,7 +50,7 @@ def render_decorator(template, **template_kw):
     """
     def _template(f):
         def _render(*args, **kw):
-            t = Template(tags, **template_kw)
+            t = get_template(tags, **template_kw)
             values = f(*args, **kw)
             return t.render(template, values)
         return _render
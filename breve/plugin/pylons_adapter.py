@@ -6,7 +6,7 @@ Earlier versions of Pylons should use the Buffet adapter.
 
 from pylons.templating import pylons_globals
 
-from breve import Template
+from breve.plugin.helpers import get_template
 from breve.tags.html import tags
 
 
@@ -22,5 +22,5 @@ def render(template_name, tmpl_params=None, loader=None, fragment=False):
     except AttributeError:
         opts = {}
 
-    t = Template(tags, **opts)
+    t = get_template(tags, **opts)
     return t.render(template_name, params=tmpl_params, loader=loader, fragment=fragment)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+optional instrumentation of renders: wall time, number of calls and
+size of the output (in characters) per template, include, macro and
+flattener type.
+
+    with profile() as p:
+        t.render('index')
+    for row in p.report():
+        print(row)
+
+Times are inclusive, e.g. a template's time includes the includes and
+parent templates it renders.  Profiling doesn't change what templates
+see, so includes and parent templates record the time taken to
+evaluate them, while the size of their output is counted as their
+results are flattened along with the template that uses them (see
+measure()).  Macros record their time only.
+"""
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+from breve.context import _profiler
+
+
+class Profiler(object):
+    """
+    sums up timings by (kind, name).  Subclasses can override record()
+    to pass them on elsewhere, e.g. to a metrics system.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._entries = {}
+        # (kind, name) of the objects measure() was called for, by id
+        self._measured = {}
+
+    def record(self, kind, name, elapsed, size=0, calls=1):
+        with self._lock:
+            s = self.stats.get((kind, name))
+            if s is None:
+                s = self.stats[(kind, name)] = [0, 0.0, 0]
+            s[0] += calls
+            s[1] += elapsed
+            s[2] += size
+
+    def report(self):
+        """the stats as a list of dicts, slowest first"""
+        rows = [dict(kind=kind, name=name, calls=calls, time=elapsed, size=size)
+                for (kind, name), (calls, elapsed, size) in self.stats.items()]
+        return sorted(rows, key=lambda r: r['time'], reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self.stats.clear()
+            self._measured.clear()
+
+    def measure(self, o, kind, name):
+        """count the size of o's output, once it's flattened, under (kind, name)"""
+        with self._lock:
+            entry = self._measured.get(id(o))
+            if entry is None or entry[0] is not o:
+                entry = self._measured[id(o)] = (o, [])
+            entry[1].append((kind, name))
+
+    def measured(self, o):
+        """the (kind, name) o is measured for, or None, called by the flattening engines"""
+        if id(o) not in self._measured:
+            return None
+        with self._lock:
+            entry = self._measured.get(id(o))
+            if entry is None or entry[0] is not o:
+                return None
+            key = entry[1].pop(0)
+            if not entry[1]:
+                del self._measured[id(o)]
+            return key
+
+    def instrument(self, t, entry):
+        """the resolved (flattener, expander, writer) entry of type t, timed"""
+        timed = self._entries.get((t, entry))
+        if timed is None:
+            timed = self._entries[(t, entry)] = self._timed(t.__name__, *entry)
+        return timed
+
+    def _timed(self, name, f, expand, writer):
+        record = self.record
+
+        def timed_flattener(o):
+            start = perf_counter()
+            s = f(o)
+            record('flattener', name, perf_counter() - start, len(s))
+            return s
+
+        def timed_expander(o):
+            # the children are flattened, and recorded, separately
+            start = perf_counter()
+            parts = expand(o)
+            record('flattener', name, perf_counter() - start)
+            return parts
+
+        def timed_writer(o, write):
+            size = [0]
+
+            def counted(s):
+                size[0] += len(s)
+                write(s)
+            start = perf_counter()
+            writer(o, counted)
+            record('flattener', name, perf_counter() - start, size[0])
+
+        return (timed_flattener,
+                expand and timed_expander,
+                writer and timed_writer)
+
+
+@contextmanager
+def profile(profiler=None):
+    """records the renders within the block in profiler (a new Profiler by default)"""
+    if profiler is None:
+        profiler = Profiler()
+    token = _profiler.set(profiler)
+    try:
+        yield profiler
+    finally:
+        _profiler.reset(token)
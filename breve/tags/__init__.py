@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
-from copy import copy, deepcopy
+from concurrent.futures import Future
+from copy import deepcopy
+from itertools import chain
 from string import Template as sTemplate
+from time import perf_counter
+from types import AsyncGeneratorType, CoroutineType, GeneratorType
 
+from breve.context import current_context, current_profiler
 from breve.util import Namespace, escape, quoteattrs, caller
-from breve.flatten import flatten, register_flattener
+from breve.flatten import flatten, flatten_expanded, register_expander, register_flattener
 from . import _conditionals as C
 from ..util import odict
 
@@ -24,12 +29,50 @@ class Macro(object):
         self.function = function
 
     def __call__(self, *args, **kw):
-        return self.function(*args, **kw)
+        profiler = current_profiler()
+        if profiler is None:
+            return self.function(*args, **kw)
+        start = perf_counter()
+        try:
+            return self.function(*args, **kw)
+        finally:
+            profiler.record('macro', self.name, perf_counter() - start)
 
     def __str__(self):
         return ''
 
 
+class Lazy(object):
+    """
+    a data provider: calling it returns function(*args, **kw), which is
+    computed at most once per render however often it is called, used as
+    the data of tags or output.
+    """
+    __slots__ = ['function', 'args', 'kw']
+
+    def __init__(self, function, *args, **kw):
+        self.function = function
+        self.args = args
+        self.kw = kw
+
+    def __call__(self):
+        ctx = current_context()
+        if ctx is None:
+            return self.function(*self.args, **self.kw)
+        return ctx.once(ctx.data, self, lambda: self.function(*self.args, **self.kw))
+
+
+def rendered(o):
+    """the result of o.render(o, o.data), computed once per render"""
+    data = o.data
+    if isinstance(data, Lazy):
+        data = data()
+    ctx = current_context()
+    if ctx is None:
+        return o.render(o, data)
+    return ctx.once(ctx.rendered, o, lambda: o.render(o, data))
+
+
 def macro(name, function):
     """create a named reference to an anonymous function in the global namespace"""
     m = Macro(name, function)
@@ -50,24 +93,95 @@ class AutoTag(object):
         return Tag(name)
 
 
+def _plan_string(s):
+    """
+    splits s into literal strings and (name, placeholder) pairs once, so
+    it can be filled in like string.Template(s).safe_substitute(data)
+    for any number of mappings
+    """
+    parts = []
+    pos = 0
+    for m in sTemplate.pattern.finditer(s):
+        parts.append(s[pos:m.start()])
+        pos = m.end()
+        named = m.group('named') or m.group('braced')
+        if named is not None:
+            parts.append((named, m.group()))
+        elif m.group('escaped') is not None:
+            parts.append(sTemplate.delimiter)
+        else:
+            parts.append(m.group())
+    parts.append(s[pos:])
+    if not any(type(p) is tuple for p in parts):
+        text = u''.join(parts)
+        return lambda data: text
+
+    def fill(data):
+        out = []
+        for p in parts:
+            if type(p) is tuple:
+                try:
+                    p = '%s' % (data[p[0]],)
+                except KeyError:
+                    p = p[1]
+            out.append(p)
+        return u''.join(out)
+    return fill
+
+
+def _plan_tag(o):
+    """compiles o into a function returning a copy of it filled in from a mapping"""
+    name, render, data = o.name, o.render, o.data
+    attrs = [(k, _plan_string(v) if isinstance(v, str) else (lambda values, v=v: v))
+             for k, v in (o._attrs or {}).items()]
+    children = [_plan_tag(c) if isinstance(c, Tag) else _plan_string(c)
+                for c in o.children if isinstance(c, (Tag, str))]
+
+    def fill(values):
+        t = Tag(name)
+        if attrs:
+            t._attrs = {k: f(values) for k, f in attrs}
+        t.render = render
+        t.data = data
+        t.children = [f(values) for f in children]
+        return t
+    return fill
+
+
 class Tag(object):
-    __slots__ = ['name', 'children', 'attrs', 'render', 'data', 'args']
+    __slots__ = ['name', 'children', '_attrs', 'render', 'data', 'args']
 
     def __init__(self, name, *args, **kw):
         self.name = name
         self.children = []
-        self.attrs = odict(kw)
+        # most tags have no attributes, so the dict is allocated lazily
+        self._attrs = kw or None
         self.render = None
         self.data = None
 
+    @property
+    def attrs(self):
+        if self._attrs is None:
+            self._attrs = {}
+        return self._attrs
+
+    @attrs.setter
+    def attrs(self, attrs):
+        self._attrs = attrs
+
     def __call__(self, *args, **kw):
-        self.render = kw.pop('render', self.render)
-        self.data = kw.pop('data', self.data)
-        self.attrs.update(
-            dict([(k.strip(u'_'), v)
-                  for k, v in kw.items()])
-        )
-        self.attrs.update(*args)
+        if kw:
+            if 'render' in kw:
+                self.render = kw.pop('render')
+            if 'data' in kw:
+                self.data = kw.pop('data')
+            if kw:
+                attrs = self.attrs
+                for k, v in kw.items():
+                    attrs[k.strip(u'_')] = v
+        if args:
+            # a mapping, (key, value) pairs or flat key, value arguments
+            odict.update(self.attrs, *args)
         return self
 
     def __getitem__(self, k):
@@ -86,31 +200,27 @@ class Tag(object):
 
     def __copy__(self):
         t = Tag(self.name)
-        t.attrs = deepcopy(self.attrs)
+        t._attrs = deepcopy(self._attrs)
         t.data = self.data
         t.render = self.render
         t.children = self.children
         return t
 
     def __mul__(self, alist):
-        def traverse(o, data):
-            children = []
-            for k, v in sorted(o.attrs.items()):
-                o.attrs[k] = sTemplate(v).safe_substitute(data)
-            for c in o.children:
-                if isinstance(c, Tag):
-                    children.append(traverse(copy(c), data))
-                elif isinstance(c, str):
-                    children.append(sTemplate(c).safe_substitute(data))
-            o.children = children
-            return o
-
-        return [traverse(copy(self), data) for data in alist]
+        return list(self.repeat(alist))
+
+    def repeat(self, alist):
+        """
+        like tag * alist, but yields the copies one at a time so that
+        e.g. long tables needn't be built in memory before flattening
+        """
+        fill = _plan_tag(self)
+        return (fill(data) for data in alist)
 
     def find_by_attribute(self, attr, value):
         def traverse(o, attr, value):
             if isinstance(o, Tag):
-                if attr in o.attrs and o.attrs[attr] == value:
+                if o._attrs and attr in o._attrs and o._attrs[attr] == value:
                     yield o
                 for c in o.children:
                     yield traverse(c, attr, value)
@@ -154,15 +264,15 @@ class Invisible(Tag):
     pass
 
 
-def flatten_invisible(o):
+def expand_invisible(o):
     if o.render:
         # o.children = [ ]
-        t = o.render(o, o.data)
-    else:
-        t = o
-    if t.children:
-        return u''.join([flatten(c) for c in t.children])
-    return u''
+        o = rendered(o)
+    return o.children
+
+
+def flatten_invisible(o):
+    return flatten_expanded(expand_invisible(o))
 
 
 class _invisible(Proto):
@@ -178,6 +288,28 @@ def flatten_xml(o):
     return o
 
 
+#
+# opening, closing, self-closing and empty element markup, shared by
+# every tag of the same name
+#
+__markup = {}
+
+
+def tag_markup(name):
+    m = __markup.get(name)
+    if m is None:
+        if len(__markup) > 4096:
+            # autotags can make up any number of names
+            __markup.clear()
+        m = __markup[name] = (
+            xml(u'<%s>' % name),
+            xml(u'</%s>' % name),
+            xml(u'<%s />' % name),
+            xml(u'<%s></%s>' % (name, name))
+        )
+    return m
+
+
 class comment(str):
     pass
 
@@ -188,44 +320,74 @@ def flatten_comment(o):
 # standard flatteners
 
 
+def expand_tag(o):
+    """returns the opening markup, the children and the closing markup of a tag"""
+    if o.render:
+        o = rendered(o)
+        if not isinstance(o, Tag):
+            return (o,)
+
+    start, end = tag_markup(o.name)[:2]
+    if o._attrs:
+        start = xml(u'<%s%s>' % (o.name, u''.join(quoteattrs(o._attrs))))
+    return chain((start,), o.children, (end,))
+
+
 def flattened_tags(o):
     """generator that yields flattened tags"""
-    def flattened(o):
-        if o.render:
-            o = o.render(o, o.data)
-            if not isinstance(o, Tag):
-                yield flatten(o)
-                raise StopIteration
-
-        yield u'<%s%s>' % (o.name, u''.join(quoteattrs(o.attrs)))
-        for c in o.children:
-            yield flatten(c)
-        yield u'</%s>' % o.name
-        raise StopIteration
-    return flattened(o)
+    return (flatten(c) for c in expand_tag(o))
 
 
 def flatten_tag(o):
-    return ''.join(flattened_tags(o))
+    return flatten_expanded(expand_tag(o))
 
 
 def flatten_proto(p):
-    return u'<%s />' % p
+    return tag_markup(p)[2]
+
+
+def expand_sequence(o):
+    return o
 
 
 def flatten_sequence(o):
-    return u''.join([flatten(i) for i in o])
+    return flatten_expanded(o)
+
+
+def expand_callable(o):
+    return (o(),)
 
 
 def flatten_callable(o):
     return flatten(o())
 
 
+def expand_future(o):
+    return (o.result(),)
+
+
+def flatten_future(o):
+    return flatten(o.result())
+
+
+def expand_lazy(o):
+    return (o(),)
+
+
+def flatten_lazy(o):
+    return flatten(o())
+
+
+def flatten_async(o):
+    raise TypeError('%r can only be flattened asynchronously, e.g. by Template.render_async()' % o)
+
+
 def flatten_macro(o):
     return u''
 
 register_flattener(list, flatten_sequence)
 register_flattener(tuple, flatten_sequence)
+register_flattener(GeneratorType, flatten_sequence)
 register_flattener(Proto, flatten_proto)
 register_flattener(Tag, flatten_tag)
 register_flattener(bytes, lambda x: x.decode('utf8'))
@@ -236,6 +398,19 @@ register_flattener(comment, flatten_comment)
 register_flattener(xml, flatten_xml)
 register_flattener(type(lambda: None), flatten_callable)
 register_flattener(Macro, flatten_macro)
+register_flattener(Future, flatten_future)
+register_flattener(Lazy, flatten_lazy)
+register_flattener(CoroutineType, flatten_async)
+register_flattener(AsyncGeneratorType, flatten_async)
+
+register_expander(list, expand_sequence)
+register_expander(tuple, expand_sequence)
+register_expander(GeneratorType, expand_sequence)
+register_expander(Tag, expand_tag)
+register_expander(Invisible, expand_invisible)
+register_expander(type(lambda: None), expand_callable)
+register_expander(Future, expand_future)
+register_expander(Lazy, expand_lazy)
 
 
 def custom_tag(tag_name, class_name=None, flattener=flatten_tag, attrs=None):
@@ -253,5 +428,7 @@ def custom_tag(tag_name, class_name=None, flattener=flatten_tag, attrs=None):
     ProtoClass = type("c_%sProto" % class_name, (Proto,), {'Class': TagClass})
     register_flattener(ProtoClass, lambda o: flattener(o()))
     register_flattener(TagClass, flattener)
+    if flattener is flatten_tag:
+        register_expander(TagClass, expand_tag)
 
     return ProtoClass(tag_name)
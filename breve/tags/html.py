@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
-from breve.flatten import register_flattener
-from breve.tags import Namespace, Proto, Tag, custom_tag, flatten_tag
+import collections.abc
+
+from breve.flatten import flatten, register_flattener
+from breve.tags import Namespace, Proto, Tag, custom_tag, flatten_tag, tag_markup, xml
 from breve.tags.jsmin import jsmin
+from breve.util import escape
 
 xmlns = "http://www.w3.org/1999/xhtml"
 doctype = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
@@ -25,7 +28,7 @@ class HtmlProto(str):
 
 
 def flatten_htmlproto(p):
-    return '<%s></%s>' % (p, p)
+    return tag_markup(p)[3]
 
 register_flattener(HtmlProto, flatten_htmlproto)
 
@@ -116,6 +119,37 @@ def flatten_option(o):
 option = custom_tag('option', flattener=flatten_option)
 
 
+def table_rows(rows, columns=None, cell_tag='td', row_tag='tr'):
+    """
+    markup for many table rows at once, without a Tag per cell.  rows is
+    an iterable of sequences, or of mappings if the keys to output are
+    given as columns, or a mapping of column names to sequences (e.g.
+    arrays) of values.  Strings are escaped, None is left blank and
+    anything else is flattened.
+    """
+    if isinstance(rows, collections.abc.Mapping):
+        rows = zip(*[rows[c] for c in (columns or list(rows))])
+    elif columns is not None:
+        rows = ([row[c] for c in columns] for row in rows)
+    row_start, row_end = tag_markup(row_tag)[:2]
+    start, end = tag_markup(cell_tag)[:2]
+    out = []
+    for row in rows:
+        out.append(row_start)
+        for v in row:
+            if type(v) is str:
+                v = escape(v)
+            elif v is None:
+                v = u''
+            else:
+                v = flatten(v)
+            out.append(start)
+            out.append(v)
+            out.append(end)
+        out.append(row_end)
+    return xml(u''.join(out))
+
+
 class lorem_ipsum(Tag):
     """ silliness ensues """
     children = [
@@ -144,6 +178,7 @@ tags.update(dict(
     inlineJS=inlineJS,
     minJS=minJS,
     lorem_ipsum=lorem_ipsum,
+    table_rows=table_rows,
 ))
 
 # TAGS = Namespace ( )
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from breve.flatten import register_flattener
-from breve.tags import Namespace, Tag
+from breve.tags import Namespace, Tag, rendered
 from breve.tags.html import tags as htmltags
 from breve.tags.html import HtmlProto, empty_tag_names
 from breve.util import quoteattrs
@@ -19,7 +19,7 @@ class Html4EmptyTag(Tag):
 
 def flatten_empty_html4_tag(o):
     if o.render:
-        o = o.render(o, o.data)
+        o = rendered(o)
 
     attrs = u''.join(quoteattrs(o.attrs))
     return u'<%s%s>' % (o.name, attrs)
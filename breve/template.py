@@ -1,16 +1,25 @@
 # -*- coding: utf-8 -*-
 #! /usr/bin/python
+import asyncio
+import builtins
+import contextvars
 import pydoc
 import sys
+from time import perf_counter
 
 from breve.cache import Cache
-from breve.flatten import flatten
-from breve.globals import get_globals, pop, push
+from breve.compiler import STATIC, StaticCompiler
+from breve.context import (RenderContext, activate_context, current_context, current_namespace,
+                           current_profiler, enter_context, enter_namespace, exit_context,
+                           exit_namespace)
+from breve.flatten import (aflatten, aflatten_iter, flatten, flatten_expanded, flatten_iter,
+                           register_async_flattener, register_expander, register_flattener)
+from breve.globals import get_globals, get_globals_version, pop, push
 from breve.loaders import FileLoader
-from breve.tags import (AutoTag, Tag, assign, cdata, check, comment, conditionals, invisible,
-                        macro, xml)
+from breve.tags import (AutoTag, Lazy, Tag, assign, cdata, check, comment, conditionals,
+                        invisible, macro, xml)
 from breve.tags.entities import entities
-from breve.util import Namespace, caller
+from breve.util import Namespace, VersionedDict, caller
 
 try:
     import tidy as tidylib
@@ -20,6 +29,115 @@ except ImportError:
 _cache = Cache()
 _loader = FileLoader()
 
+# set while a fragment is flattened on the executor of its template
+_in_fragment = contextvars.ContextVar('breve_in_fragment', default=False)
+
+
+def _flatten_fragment(ctx, o):
+    # runs in a copy of the submitting thread's context
+    activate_context(ctx)
+    enter_namespace(None)
+    _in_fragment.set(True)
+    # flattened as a part, so a profiler measuring o sees it
+    return xml(flatten_expanded((o,)))
+
+
+def set_cache_backend(backend):
+    """
+    store fragments from cache() directives in backend (a
+    breve.cache.CacheBackend), e.g. an SQLiteCache shared by all workers
+    """
+    _cache.scache = backend
+
+
+def watch_templates(interval=1.0):
+    """
+    check the templates rendered so far for changes every interval
+    seconds in a background thread, for use with check_interval=None
+    """
+    return _cache.watch(interval)
+
+
+class Inherits(Tag):
+    """base of the inherits tags of templates, which set template"""
+    template = None
+
+
+class Override(Tag):
+    pass
+
+
+class Slot(Tag):
+    template = None
+
+
+def expand_inherits(o):
+    """
+    evaluates the parent template in place, so that the whole chain of
+    templates is flattened in a single pass with the child's
+    """
+    T = o.template
+    fragments = [c for c in o.children if isinstance(c, Override)]
+    ctx = current_context()
+    if ctx is None or ctx.template is not T:
+        # outside of a render of T
+        return (xml(T.render_partial(template=o.name, fragments=fragments)),)
+    profiler = current_profiler()
+    if profiler is None:
+        return (T._evaluate(o.name, fragments),)
+    start = perf_counter()
+    result = T._evaluate(o.name, fragments)
+    # its output is flattened along with the child's, and measured then
+    name = "%s.%s" % (o.name, T._option('extension'))
+    profiler.record('template', name, perf_counter() - start)
+    profiler.measure(result, 'template', name)
+    return (result,)
+
+
+def expand_override(o):
+    return o.children
+
+
+def expand_slot(o):
+    fragments = o.template.fragments
+    if o.name in fragments:
+        return (fragments[o.name],)
+    return o.children
+
+
+for _t, _expand in ((Inherits, expand_inherits), (Override, expand_override), (Slot, expand_slot)):
+    register_flattener(_t, lambda o, _expand=_expand: flatten_expanded(_expand(o)))
+    register_expander(_t, _expand)
+
+
+class Cached(Tag):
+    """
+    the cache() directive: flattens its children once and serves the
+    result for ttl seconds (None: until evicted) to every render using the
+    same key.  Wrap the children in a lambda to skip building them too.
+    """
+
+    def __init__(self, key, ttl=None):
+        Tag.__init__(self, key, ttl=ttl)
+
+
+def flatten_cached(o):
+    return _cache.memoize(o.name, o.attrs['ttl'],
+                          lambda: xml(u''.join([flatten(c) for c in o.children])))
+
+
+async def aflatten_cached(o):
+    scache = _cache.scache
+    result = scache.get(o.name, scache)
+    if result is scache:
+        result = xml(await aflatten(o.children))
+        scache.set(o.name, result, o.attrs['ttl'])
+    return result
+
+
+register_flattener(Cached, flatten_cached)
+register_async_flattener(Cached, aflatten_cached)
+
 
 class Template(object):
     cgitb = True
@@ -29,12 +147,44 @@ class Template(object):
     extension = 'b'
     mashup_entities = False  # set to True for old 1.0 behaviour
     autotags = None
-    loaders = [_loader]
+    precompile = False  # fold static subtrees at compile time, see breve.compiler
+    cache_dir = None  # directory for keeping compiled templates across processes
+    check_interval = 0  # seconds between checks for template changes, None: never
+    loaders = [_loader]  # default loader stack, copied into every render context
+    executor = None  # concurrent.futures executor to flatten included fragments on, see include()
+    _tags = None
+    _compiler = None
+    _compiler_version = None
+    _namespace = None
+    _namespace_version = None
+    _idle = None
+
+    # tags can be changed at any time, the namespace and static compiler
+    # built from them are kept up to date by their version
+    @property
+    def tags(T):  # @NoSelf
+        return T._tags
+
+    @tags.setter
+    def tags(T, tags):  # @NoSelf
+        T._tags = VersionedDict(tags)
+
+    def _tags_version(T):  # @NoSelf
+        return id(T._tags), T._tags.version
+
+    # options that can be given to the constructor and the render methods;
+    # those given to a render method are kept in its render context
+    _options = ('tidy', 'debug', 'namespace', 'mashup_entities', 'extension', 'autotags', 'cgitb',
+                'precompile', 'cache_dir', 'check_interval', 'executor')
 
     def _update_params(T, **kw):  # @NoSelf
-        for _a in ('tidy', 'debug', 'namespace', 'mashup_entities', 'extension', 'autotags', 'cgitb'):
+        for _a in T._options:
             setattr(T, _a, kw.get(_a, getattr(T, _a)))
 
+    def _option(T, name):  # @NoSelf
+        """option name of the current render, as given to it or else to the template"""
+        return T._context.options.get(name, getattr(T, name))
+
     def __init__(T, tags, root='.', xmlns=None, doctype=None, **kw):  # @NoSelf
         """
         Uses "T" rather than "self" to avoid confusion with
@@ -43,57 +193,40 @@ class Template(object):
         """
         T._update_params(**kw)
 
-        class inherits(Tag):
-
-            def __str__(self):
-                return T.render_partial(
-                    template=self.name,
-                    fragments=[c for c in self.children
-                               if isinstance(c, override)]
-                )
-
-        class override(Tag):
+        # the inherits, override and slot tags are expanded in the same
+        # flattening pass as the rest of the output (see expand_inherits)
+        class inherits(Inherits):
+            template = T
 
-            def __str__(self):
-                if self.children:
-                    return u''.join([flatten(c) for c in self.children])
-                return u''
-
-        class slot(Tag):
-
-            def __str__(self):
-                if self.name in T.fragments:
-                    return xml(flatten(T.fragments[self.name]))
-                if self.children:
-                    return u''.join([flatten(c) for c in self.children])
-                return u''
+        class slot(Slot):
+            template = T
 
         def preamble(**kw):
-            T.__dict__.update(kw)
+            # e.g. doctype or xml_encoding, for this render only
+            T._context.preamble.update(kw)
             return ''
 
         T.root = root
         T.xmlns = xmlns
         T.xml_encoding = """<?xml version="1.0" encoding="UTF-8"?>"""
         T.doctype = doctype
-        T.fragments = {}
-        T.render_path = []  # not needed but potentially useful
-
-        T.params = Namespace({'xmlns': xmlns})
         T.tags = {'cdata': cdata,
                   'xml': xml,
                   'check': check,
                   'push': push,
                   'pop': pop,
                   'macro': macro,
+                  'lazy': Lazy,
                   'assign': assign,
                   'comment': comment,
                   'invisible': invisible,
                   'include': T.include,
                   'inherits': inherits,
-                  'override': override,
+                  'override': Override,
                   'slot': slot,
-                  'preamble': preamble}
+                  'cache': Cached,
+                  'preamble': preamble,
+                  STATIC: xml}
         if T.mashup_entities:
             T.tags.update(entities)
         T.tags.update(E=entities)  # fallback in case of name clashes
@@ -102,28 +235,98 @@ class Template(object):
         if T.autotags:
             T.tags[T.autotags] = AutoTag()
 
+    # per-render state lives in the render context (see breve.context),
+    # so that one template can render concurrently in threads or tasks
+    @property
+    def _context(T):  # @NoSelf
+        ctx = current_context()
+        if ctx is None or ctx.template is not T:
+            # outside of renders
+            if T._idle is None:
+                T._idle = RenderContext(T, T.loaders)
+            ctx = T._idle
+        return ctx
+
+    @property
+    def params(T):  # @NoSelf
+        return T._context.params
+
+    @property
+    def fragments(T):  # @NoSelf
+        return T._context.fragments
+
+    @property
+    def render_path(T):  # @NoSelf
+        """not needed but potentially useful"""
+        return T._context.render_path
+
     def include(T, template, params=None, loader=None):  # @NoSelf
         """
-        evalutes template fragment(s) in the current (caller's) context
+        evalutes template fragment(s) in the current (caller's) context.
+
+        If the template has an executor, every fragment is then flattened
+        on it while the rest of the output is produced, so fragments with
+        slow callables or data providers are rendered concurrently.  This
+        is for independent fragments: the order in which they and the
+        rest of the page are flattened isn't defined (e.g. for push()
+        and pop()).  Each fragment gets its own copy of the render
+        context, except for the stacks and the lazy values and renderer
+        results computed once per render.
+
+        Don't render the template itself on the same executor: waiting
+        for the fragments would block one of its threads, so with every
+        thread rendering a page nothing is left to flatten fragments.
         """
         if isinstance(template, str):
             template = [template]
 
+        ctx = T._context
+        _globals = current_namespace()
+        if _globals is None:
+            # called while flattening rather than evaluating a template
+            _globals = caller().f_globals
+        loaders = ctx.loaders
+        # outside of renders the context lives on, so nothing is kept
+        includes = ctx.includes if ctx is not T._idle else {}
+        profiler = current_profiler()
+        # fragments flattened on the executor flatten their own includes,
+        # so as not to wait for tasks queued behind them
+        options = ctx.options
+        extension = options.get('extension', T.extension)
+        precompile = options.get('precompile', T.precompile)
+        executor = options.get('executor', T.executor) if not _in_fragment.get() else None
         results = []
         for tpl in template:
             locals_ = {}
             if params:
                 locals_.update(params)
-            frame = caller()
-            filename = "%s.%s" % (tpl, T.extension)
             if loader:
-                T.loaders.append(loader)
+                loaders.append(loader)
+            if profiler is not None:
+                start = perf_counter()
             try:
-                code = _cache.compile(filename, T.root, T.loaders[-1])
-                result = eval(code, frame.f_globals, locals_)
+                # folded bytecode depends on the names the parameters shadow
+                key = (tpl, tuple(locals_) if precompile else ())
+                cached = includes.get(key)
+                if cached is not None and cached[0] is loaders[-1]:
+                    code = cached[1]
+                else:
+                    filename = "%s.%s" % (tpl, extension)
+                    code = T._compile(filename, loaders[-1], locals_)
+                    includes[key] = (loaders[-1], code)
+                result = eval(code, _globals, locals_)
             finally:
                 if loader:
-                    T.loaders.pop()
+                    loaders.pop()
+            if profiler is not None:
+                # the result is flattened along with the caller's output,
+                # and measured then
+                name = "%s.%s" % (tpl, extension)
+                profiler.record('include', name, perf_counter() - start)
+                profiler.measure(result, 'include', name)
+            if executor is not None:
+                result = executor.submit(contextvars.copy_context().run, _flatten_fragment,
+                                         ctx.child(), result)
             results.append(result)
         return results
 
@@ -146,59 +349,102 @@ class Template(object):
     #             T.loaders.pop()
     #     return result
 
-    def _evaluate(T, template, fragments=None, params=None, loader=None, **kw):  # @NoSelf
-        filename = "%s.%s" % (template, T.extension)
-
-        T._update_params(**kw)
+    def _compile(T, filename, loader, locals_=None):  # @NoSelf
+        options = T._context.options
+        cache_dir = options.get('cache_dir', T.cache_dir)
+        check_interval = options.get('check_interval', T.check_interval)
+        if options.get('precompile', T.precompile):
+            version = T._tags_version()
+            if T._compiler_version != version:
+                T._compiler = StaticCompiler(T.tags)
+                T._compiler_version = version
+            bytecode, names = _cache.compile_static(filename, T.root, loader, T._compiler,
+                                                    check_interval)
+            # parameters shadowing a folded tag need the unfolded bytecode
+            if names.isdisjoint(T.params._dict) and names.isdisjoint(get_globals()) and \
+                    names.isdisjoint(locals_ or ()):
+                return bytecode
+        return _cache.compile(filename, T.root, loader, cache_dir, check_interval)
+
+    def _builtins(T):  # @NoSelf
+        """builtins, tags and globals (in increasing priority) as one dict"""
+        version = get_globals_version(), T._tags_version()
+        if T._namespace_version != version:
+            ns = dict(builtins.__dict__)
+            ns.update(T.tags)
+            ns.update(get_globals())
+            T._namespace = ns
+            T._namespace_version = version
+        return T._namespace
 
-        T.render_path.append(template)
-        T.params['__this__'] = T
-        T.params['__templates__'] = T.render_path
-        T.params['__namespace'] = T.namespace
+    def _evaluate(T, template, fragments=None, params=None, loader=None, **kw):  # @NoSelf
+        ctx = T._context
+        if kw:
+            # for this render only, so that renders sharing T don't race
+            ctx.options.update((k, v) for k, v in kw.items() if k in T._options)
+        namespace = ctx.options.get('namespace', T.namespace)
+        filename = "%s.%s" % (template, ctx.options.get('extension', T.extension))
+
+        ctx.render_path.append(template)
+        ctx.params['__this__'] = T
+        ctx.params['__templates__'] = ctx.render_path
+        ctx.params['__namespace'] = namespace
 
         if loader:
-            T.loaders.append(loader)
+            ctx.loaders.append(loader)
 
         if fragments:
             for f in fragments:
-                if f.name not in T.fragments:
-                    T.fragments[f.name] = f
-
-        T.params._dict.update(get_globals())
-        _g = {}
-        _g.update(T.tags)
-        if T.namespace:
-            if not T.namespace in T.params:
-                T.params[T.namespace] = Namespace()
+                if f.name not in ctx.fragments:
+                    ctx.fragments[f.name] = f
+
+        if namespace:
+            if not namespace in ctx.params:
+                ctx.params[namespace] = Namespace()
             if params:
-                T.params[T.namespace]._dict.update(params)
+                ctx.params[namespace]._dict.update(params)
         else:
             if params:
-                T.params._dict.update(params)
-        _g.update(T.params)
-
+                ctx.params._dict.update(params)
+        # tags and globals are looked up in a prebuilt builtins layer,
+        # so only the parameters are copied per render
+        _g = {'__builtins__': T._builtins()}
+        _g.update(ctx.params._dict)
+
+        # include() evaluates fragments in the same namespace
+        token = enter_namespace(_g)
         try:
-            bytecode = _cache.compile(filename, T.root, T.loaders[-1])
+            bytecode = T._compile(filename, ctx.loaders[-1])
             result = eval(bytecode, _g, {})
         finally:
-            T.render_path.pop()
+            exit_namespace(token)
+            ctx.render_path.pop()
             if loader:
-                T.loaders.pop()
+                ctx.loaders.pop()
 
         return result
 
     def render_partial(T, template, fragments=None, params=None, loader=None, **kw):  # @NoSelf
+        _ctx, token = enter_context(T)
+        profiler = current_profiler()
+        if profiler is not None:
+            start = perf_counter()
         try:
             result = T._evaluate(template, fragments, params, loader, **kw)
             output = flatten(result)
+            if profiler is not None:
+                profiler.record('template', "%s.%s" % (template, T._option('extension')),
+                                perf_counter() - start, len(output))
         except:
-            if T.debug:
+            if _ctx.options.get('debug', T.debug):
                 return T.debug_out(sys.exc_info()[:-1], template)
             else:
                 # print "Error in template ( %s )" % template
                 raise
+        finally:
+            exit_context(token)
 
-        if T.tidy and tidylib:
+        if _ctx.options.get('tidy', T.tidy) and tidylib:
             options = dict(input_xml=True,
                            output_xhtml=True,
                            add_xml_decl=False,
@@ -213,14 +459,100 @@ class Template(object):
             return output
 
     def render(T, template, params=None, loader=None, fragment=False, **kw):  # @NoSelf
-        if loader:
-            T.loaders.append(loader)
-        output = T.render_partial(template, params=params, **kw)
-        if loader:
-            T.loaders.pop()
+        ctx, token = enter_context(T)
+        try:
+            if loader:
+                ctx.loaders.append(loader)
+            output = T.render_partial(template, params=params, **kw)
+            if loader:
+                ctx.loaders.pop()
+        finally:
+            exit_context(token)
         if fragment:
             return output
-        return u'\n'.join([T.xml_encoding or u'', T.doctype or u'', output])
+        return u'\n'.join([T._prologue(ctx), output])
+
+    def render_iter(T, template, params=None, loader=None, fragment=False,  # @NoSelf
+                    bufsize=8192, encoding=None, **kw):
+        """
+        like render(), but returns a generator that yields the output in
+        chunks of about bufsize characters (encoded if an encoding is
+        given) so that e.g. a WSGI application can return it directly.
+
+        The template is evaluated before this method returns, so errors
+        in it are raised here rather than halfway through the response.
+        The output is never passed through tidy.
+        """
+        context, result = T._detach(template, params, loader, fragment, **kw)
+        chunks = T._stream(context, flatten_iter(result, bufsize))
+        if encoding:
+            return (c.encode(encoding) for c in chunks)
+        return chunks
+
+    def render_async(T, template, params=None, loader=None, fragment=False,  # @NoSelf
+                     bufsize=8192, encoding=None, **kw):
+        """
+        like render_iter(), but returns an async generator, and the output
+        may contain awaitables (coroutines, futures, ...) and async
+        iterables, which are awaited and iterated in their place.  The
+        awaitables among the children of a tag are awaited concurrently.
+        """
+        context, result = T._detach(template, params, loader, fragment, **kw)
+        return T._stream_async(context, aflatten_iter(result, bufsize), encoding)
+
+    def _detach(T, template, params, loader, fragment, **kw):  # @NoSelf
+        """
+        evaluates template for output that is produced later, returns the
+        context to produce it in and the result
+        """
+        ctx, token = enter_context(T)
+        try:
+            if loader:
+                ctx.loaders.append(loader)
+            result = T._evaluate(template, params=params, **kw)
+            # the parent templates may call preamble(), so they're
+            # evaluated before the prologue is
+            profiler = current_profiler()
+            measured = []
+            while isinstance(result, Inherits):
+                if profiler is not None:
+                    measured.append(profiler.measured(result))
+                result, = expand_inherits(result)
+            # the output of each parent expanded here is that of the last
+            for key in reversed(measured):
+                if key is not None:
+                    result = (result,)
+                    profiler.measure(result, *key)
+            # inherits() and friends render at flatten time, so the
+            # output has to be produced within this render's context
+            context = contextvars.copy_context()
+        finally:
+            exit_context(token)
+        if not fragment:
+            result = [xml(T._prologue(ctx) + u'\n'), result]
+        return context, result
+
+    def _prologue(T, ctx):  # @NoSelf
+        """the xml declaration and doctype, as set by preamble() if it was called"""
+        return u'\n'.join([ctx.preamble.get('xml_encoding', T.xml_encoding) or u'',
+                            ctx.preamble.get('doctype', T.doctype) or u''])
+
+    def _stream(T, context, chunks):  # @NoSelf
+        while True:
+            try:
+                chunk = context.run(next, chunks)
+            except StopIteration:
+                return
+            yield chunk
+
+    async def _stream_async(T, context, chunks, encoding):  # @NoSelf
+        while True:
+            try:
+                # tasks run in a copy of the context they're created in
+                chunk = await context.run(asyncio.ensure_future, chunks.__anext__())
+            except StopAsyncIteration:
+                return
+            yield chunk.encode(encoding) if encoding else chunk
 
     def debug_out(self, exc_info, filename):
         import cgitb
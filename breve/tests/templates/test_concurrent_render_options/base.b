@@ -0,0 +1 @@
+div(class_=__namespace) [ slot('content') ]
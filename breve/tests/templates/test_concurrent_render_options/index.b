@@ -0,0 +1,3 @@
+inherits('base') [
+    override('content') [ v.pause(), v.message ]
+]
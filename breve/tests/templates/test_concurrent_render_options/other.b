@@ -0,0 +1 @@
+div [ 'other' ]
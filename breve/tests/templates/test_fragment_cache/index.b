@@ -0,0 +1,12 @@
+html [
+    head [ title [ v.title ] ],
+    body [
+        cache ( key = 'test_fragment_cache:sidebar', ttl = 60 ) [
+            div ( class_ = 'sidebar' ) [ 'rendered for ', v.counter ]
+        ],
+        cache ( 'test_fragment_cache:lazy' ) [
+            lambda: div [ 'rendered for ', v.counter ]
+        ],
+        div [ 'rendered for ', v.counter ]
+    ]
+]
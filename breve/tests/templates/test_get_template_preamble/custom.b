@@ -0,0 +1,2 @@
+preamble(doctype='<!DOCTYPE custom>'),
+p [ 'custom' ]
@@ -0,0 +1 @@
+p [ 'plain' ]
@@ -0,0 +1 @@
+div [ items, items, ul(render=render_list, data=rows), rows, len(rows()) ]
@@ -0,0 +1 @@
+span [ rows ], items
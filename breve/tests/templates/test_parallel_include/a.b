@@ -0,0 +1 @@
+span [ 'a', where ]
@@ -0,0 +1 @@
+span [ 'b', where ]
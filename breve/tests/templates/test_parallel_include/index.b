@@ -0,0 +1 @@
+div [ include(['a', 'b']), include('a') ]
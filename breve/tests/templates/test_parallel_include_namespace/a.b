@@ -0,0 +1 @@
+inherits('base') [ override('content') [ 'a' ] ]
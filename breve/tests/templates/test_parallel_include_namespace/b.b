@@ -0,0 +1 @@
+span [ n ]
@@ -0,0 +1 @@
+div [ in_base(), slot('content') ]
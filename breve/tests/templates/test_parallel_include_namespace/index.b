@@ -0,0 +1 @@
+div [ include('a'), assign('n', 5), wait_for_base(), include('b'), release_base() ]
@@ -0,0 +1,2 @@
+assign('title', 'Welcome'),
+div[h1[title]]
@@ -0,0 +1,2 @@
+macro('menu', lambda: ul[li['home']]),
+div[menu()]
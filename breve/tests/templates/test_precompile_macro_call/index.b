@@ -0,0 +1,2 @@
+macro('title', lambda text: h1(class_='title')[text]),
+div[title('Welcome')]
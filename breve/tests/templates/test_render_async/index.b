@@ -0,0 +1 @@
+div [ first, second, ul [ items ] ]
@@ -0,0 +1 @@
+div [ cache('test_render_async_cache') [ value ], include('fragment') ]
@@ -0,0 +1,4 @@
+preamble(doctype='<!DOCTYPE html>'),
+html [
+    body [ slot('content') ]
+]
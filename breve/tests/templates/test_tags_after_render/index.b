@@ -0,0 +1 @@
+div [ mytag, box [ 'x' ] ]
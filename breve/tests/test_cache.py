@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from breve.cache import Cache, LRUCache, SQLiteCache
+
+
+def test_lru_eviction():
+    """least recently used entries are evicted first"""
+    c = LRUCache(max_entries=2)
+    c.set('a', 'A')
+    c.set('b', 'B')
+    assert c.get('a') == 'A'
+    c.set('c', 'C')
+    assert 'b' not in c
+    assert c.get('a') == 'A'
+    assert c.get('c') == 'C'
+    assert c.stats() == dict(entries=2, bytes=c.bytes, hits=3, misses=0, evictions=1)
+
+
+def test_lru_max_bytes():
+    """size accounting"""
+    c = LRUCache(max_bytes=10, sizeof=len)
+    c.set('a', '12345')
+    c.set('b', '12345')
+    assert c.bytes == 10
+    c.set('c', '123')
+    assert 'a' not in c and c.bytes == 8
+    c.set('d', '12345678901')
+    assert 'd' not in c and len(c) == 2
+
+
+def test_lru_ttl():
+    """expired entries count as misses"""
+    c = LRUCache()
+    c.set('a', 'A', ttl=-1)
+    c.set('b', 'B', ttl=60)
+    assert c.get('a') is None
+    assert c.get('b') == 'B'
+    assert (c.hits, c.misses) == (1, 1)
+    assert len(c) == 1
+
+
+def test_lru_invalidate():
+    """invalidation by key and prefix"""
+    c = LRUCache()
+    for k in ('user:1:menu', 'user:1:sidebar', 'user:2:menu', 'site'):
+        c.set(k, k)
+    c.invalidate('site')
+    c.invalidate('missing')
+    c.invalidate_prefix('user:1:')
+    assert list(c.entries) == ['user:2:menu']
+    c.clear()
+    assert len(c) == 0 and c.bytes == 0
+
+
+def test_memoize():
+    """Cache.memoize computes once per timeout"""
+    calls = []
+
+    def render(x):
+        calls.append(x)
+        return 'rendered %s' % x
+
+    cache = Cache(max_entries=1)
+    assert cache.memoize('a', 60, render, 1) == 'rendered 1'
+    assert cache.memoize('a', 60, render, 2) == 'rendered 1'
+    assert cache.memoize('b', 60, render, 3) == 'rendered 3'
+    assert cache.memoize('a', 60, render, 4) == 'rendered 4'
+    assert calls == [1, 3, 4]
+    assert cache.scache.evictions == 2
+
+
+def test_sqlite_backend():
+    """fragments in an SQLiteCache are shared between instances"""
+    import os
+    import tempfile
+    from breve.tags import xml
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'fragments.db')
+        worker1 = SQLiteCache(path, max_entries=2)
+        worker2 = SQLiteCache(path, max_entries=2)
+        worker1.set('nav', xml('<ul></ul>'))
+        value = worker2.get('nav')
+        assert value == '<ul></ul>' and isinstance(value, xml)
+        worker2.set('user:1', 'one', ttl=-1)
+        assert worker1.get('user:1', 'gone') == 'gone'
+        worker2.set('user:2', 'two')
+        worker2.set('user:3', 'three')
+        assert len(worker1) == 2 and 'nav' not in worker1
+        worker1.invalidate_prefix('user:')
+        assert len(worker2) == 0
+        assert worker1.stats()['hits'] == 0 and worker2.stats()['evictions'] == 1
+
+
+def test_incomplete_backend():
+    """backends must implement the whole interface"""
+    from breve.cache import CacheBackend
+
+    class GetOnly(CacheBackend):
+        def get(self, key, default=None):
+            return default
+
+    try:
+        GetOnly()
+    except TypeError:
+        pass
+    else:
+        assert False, 'incomplete backend created'
+
+
+def test_memoize_backend():
+    """Cache.memoize with another backend"""
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'fragments.db')
+        calls = []
+        for _worker in range(2):
+            cache = Cache(backend=SQLiteCache(path))
+            assert cache.memoize('a', 60, lambda: calls.append(1) or 'A') == 'A'
+        assert calls == [1]
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-from breve.flatten import flatten
+from breve.flatten import (flatten, flatten_iter, flatten_to, register_flattener,
+                           unregister_flattener)
 from breve.tags import AutoTag, Tag, assign, check, macro, xml
 from breve.tags.entities import entities as E
 from breve.tags.html import tags as T
@@ -18,6 +19,94 @@ def test_tag_serialization():
                       '<body><div>okay</div></body></html>')
 
 
+def test_flatten_iter():
+    """incremental flattening"""
+    template = T.html[
+        T.head[T.title[my_name()]],
+        T.body[
+            T.ul(class_='list')[[T.li['item %d' % _i] for _i in range(100)]],
+            T.br,
+            lambda: T.p['&escaped&']
+        ]
+    ]
+    expected = flatten(template)
+    unbuffered = list(flatten_iter(template, bufsize=None))
+    assert len(unbuffered) > 100
+    assert ''.join(unbuffered) == expected
+    chunks = list(flatten_iter(template, bufsize=256))
+    assert ''.join(chunks) == expected
+    assert all(len(_c) >= 256 for _c in chunks[:-1])
+    assert len(chunks[-1]) <= len(expected) - 256 * (len(chunks) - 1)
+
+
+def test_deep_nesting():
+    """documents nested deeper than the recursion limit"""
+    import sys
+    depth = sys.getrecursionlimit() * 3
+    template = 'leaf'
+    for _i in range(depth):
+        template = T.div[template]
+    expected = '<div>' * depth + 'leaf' + '</div>' * depth
+    assert flatten(template) == expected
+    assert ''.join(flatten_iter(template)) == expected
+    assert flatten([[[template]]]) == expected
+
+
+def test_subclass_flattening():
+    """subclasses use the flattener registered for their closest base"""
+    class Markup(str):
+        pass
+
+    class Section(Tag):
+        pass
+
+    class Rendered(Tag):
+        def __str__(self):
+            return 'rendered %s' % self.name
+
+    template = T.div[Markup('<&>'), Section('section')['<&>'], Rendered('x'), Section('s')]
+    expected = ('<div>&lt;&amp;&gt;<section>&lt;&amp;&gt;</section>rendered x<s></s></div>')
+    assert flatten(template) == expected
+    assert ''.join(flatten_iter(template)) == expected
+
+    register_flattener(Markup, str)
+    try:
+        assert flatten(template).startswith('<div><&><section>')
+    finally:
+        unregister_flattener(Markup)
+    assert flatten(template) == expected
+
+
+def test_writer_flattener():
+    """flatteners writing into the output buffer"""
+    class Card(object):
+        def __init__(self, title, *children):
+            self.title = title
+            self.children = children
+
+    def write_card(o, write):
+        write('<section><h2>')
+        flatten_to(o.title, write)
+        write('</h2>')
+        for c in o.children:
+            flatten_to(c, write)
+        write('</section>')
+
+    register_flattener(Card, write_card, writer=True)
+    try:
+        template = T.div[Card('A & B', T.p['one'], Card('nested', 'two'))]
+        expected = ('<div><section><h2>A &amp; B</h2><p>one</p>'
+                    '<section><h2>nested</h2>two</section></section></div>')
+        assert flatten(template) == expected
+        assert ''.join(flatten_iter(template, bufsize=10)) == expected
+        out = []
+        flatten_to(template, out.append)
+        assert ''.join(out) == expected
+        assert '<section><h2>' in out and '</section>' in out
+    finally:
+        unregister_flattener(Card)
+
+
 def test_inlineJS():
     """inline Javascript flattening"""
     js = """
@@ -123,6 +212,39 @@ def test_escaping():
                       '</body></html>')
 
 
+def test_attribute_values():
+    """attribute quoting for different value types"""
+    from breve.util import escape, quoteattrs
+    for _i in range(2):  # second round is served from the cache
+        assert quoteattrs(dict(a='x "y" <&>', b=1, c=1.0, d=None, e=b'\xc3\xa9')) == [
+            ' a="x &quot;y&quot; &lt;&amp;&gt;"', ' b="1"', ' c="1.0"', ' e="\xe9"']
+    plain = 'nothing to escape'
+    assert escape(plain) is plain
+    assert escape('<&>') == '&lt;&amp;&gt;'
+
+
+def test_tag_markup():
+    """open and close markup is shared by tags of the same name"""
+    from breve.tags import custom_tag, tag_markup
+    assert tag_markup(T.div) is tag_markup('div')
+    assert flatten(T.div) == '<div></div>'
+    assert flatten(T.br) == '<br />'
+    assert flatten([T.span, T.span['x'], T.span(class_='y')['z']]) == (
+        '<span></span><span>x</span><span class="y">z</span>')
+    mytag = custom_tag('mytag', attrs=dict(a='1'))
+    assert flatten([mytag, mytag['x']]) == '<mytag a="1"></mytag><mytag a="1">x</mytag>'
+
+
+def test_tag_attributes():
+    """attributes from keywords, mappings and pairs"""
+    t = T.div['x']
+    assert t._attrs is None
+    assert flatten(t(class_='a', render=None)) == '<div class="a">x</div>'
+    assert flatten(T.div({'id': 'b'})) == '<div id="b"></div>'
+    assert flatten(T.div('id', 'c', 'title', 'd')) == '<div id="c" title="d"></div>'
+    assert T.div().attrs == {}
+
+
 def test_tag_multiplication():
     """tag multiplication"""
     url_data = [
@@ -146,6 +268,29 @@ def test_tag_multiplication():
                       '<li><a href="http://www.amazon.com">Amazon</a></li></ul></body></html>')
 
 
+def test_tag_repeat():
+    """tag multiplication placeholders, lazily"""
+    row = T.tr(class_='$kind')[T.td['$name'], T.td['${price} $$'], T.td['$missing', 1]]
+    rows = row.repeat([dict(kind='a', name='<x>', price=1), dict(kind='b', name='y', price=2.5)])
+    assert not isinstance(rows, list)
+    assert flatten(rows) == ('<tr class="a"><td>&lt;x&gt;</td><td>1 $</td><td>$missing</td></tr>'
+                             '<tr class="b"><td>y</td><td>2.5 $</td><td>$missing</td></tr>')
+    assert flatten(row * [dict(kind='c')]) == (
+        '<tr class="c"><td>$name</td><td>${price} $</td><td>$missing</td></tr>')
+
+
+def test_table_rows():
+    """bulk table rows"""
+    output = flatten(T.table[T.table_rows([('a<', 1), ('b', None)])])
+    assert output == ('<table><tr><td>a&lt;</td><td>1</td></tr>'
+                      '<tr><td>b</td><td></td></tr></table>')
+    rows = [dict(name='a', price=1.5, id=1)]
+    assert T.table_rows(rows, columns=['name', 'price'], cell_tag='th') == (
+        '<tr><th>a</th><th>1.5</th></tr>')
+    columns = dict(name=['a', 'b'], cell=[T.b['x'], 2])
+    assert T.table_rows(columns) == '<tr><td>a</td><td><b>x</b></td></tr><tr><td>b</td><td>2</td></tr>'
+
+
 def test_flatten_callable():
     """test flattening of callables"""
     def my_callable():
@@ -25,7 +25,7 @@ def test_instantiation_parameters():
 
 
 def test_render_parameters():
-    """test render-time parameters"""
+    """test render-time parameters, which apply to that render only"""
     params = dict(
         message='hello, from breve',
         title=my_name()
@@ -34,15 +34,41 @@ def test_render_parameters():
         'tidy': True,
         'debug': True,
         'namespace': 'v',
-        'extension': '.breve'
+        'extension': 'breve'
     }
     t = Template(html, root=template_root())
-    t.render('index', params, **args)
+    assert t.render('index', params, **args) == expected_output()
     actual = [getattr(t, k, 'not_set') for k in sorted(args)]
-    expected = [v for k, v in sorted(args.items())]
+    expected = [getattr(Template, k) for k in sorted(args)]
     assert actual == expected
 
 
+def test_concurrent_render_options():
+    """renders of one template in threads don't see each other's options"""
+    import threading
+    paused, resume = threading.Event(), threading.Event()
+
+    def pause():
+        # base.b is evaluated after the other render
+        paused.set()
+        resume.wait(5)
+        return ''
+
+    t = Template(html, root=template_root())
+    output = []
+    thread = threading.Thread(target=lambda: output.append(
+        t.render('index', dict(pause=pause, message='hello, from breve'), fragment=True,
+                 namespace='v')))
+    thread.start()
+    assert paused.wait(5)
+    try:
+        assert t.render('other', fragment=True, namespace='') == '<div>other</div>'
+    finally:
+        resume.set()
+        thread.join()
+    assert output == [expected_output()]
+
+
 def test_simple_template():
     """simple template"""
     params = dict(
@@ -55,6 +81,175 @@ def test_simple_template():
     assert actual == expected
 
 
+def test_render_iter():
+    """render_iter() streams the same output as render()"""
+    params = dict(
+        message='hello, from breve',
+        title='test_nested_inheritance'
+    )
+    root = os.path.join(os.path.dirname(template_root()), 'test_nested_inheritance')
+    t = Template(html, root=root)
+    expected = t.render('index', params, namespace='v')
+    actual = ''.join(t.render_iter('index', params, namespace='v', bufsize=16))
+    assert actual == expected
+    encoded = b''.join(t.render_iter('index', params, namespace='v', encoding='utf-8'))
+    assert encoded == expected.encode('utf-8')
+    fragment = ''.join(t.render_iter('index', params, namespace='v', fragment=True))
+    assert fragment == t.render('index', params, namespace='v', fragment=True)
+
+
+def test_stream_preamble():
+    """the preamble() of a parent template is streamed like render() outputs it"""
+    import asyncio
+
+    async def render(t):
+        return ''.join([c async for c in t.render_async('index', params)])
+
+    params = dict(message='hello, from breve')
+    t = Template(html, root=template_root())
+    assert t.render('index', params) == expected_output()
+    assert ''.join(t.render_iter('index', params)) == expected_output()
+    assert asyncio.run(render(t)) == expected_output()
+
+
+def test_render_async():
+    """render_async() awaits the awaitables in the output concurrently"""
+    import asyncio
+
+    async def first(ready):
+        # only finishes if second() runs meanwhile
+        await asyncio.wait_for(ready.wait(), 1)
+        return html.b['first']
+
+    async def second(ready):
+        ready.set()
+        return '<second>'
+
+    async def items():
+        for i in range(2):
+            await asyncio.sleep(0)
+            yield html.li[i]
+
+    async def render(t):
+        ready = asyncio.Event()
+        params = dict(first=first(ready), second=second(ready), items=items())
+        return ''.join([c async for c in t.render_async('index', params, fragment=True, bufsize=1)])
+
+    t = Template(html, root=template_root())
+    assert asyncio.run(render(t)) == expected_output()
+
+
+def test_render_async_cache():
+    """render_async() of cache() directives and includes, with a profiler"""
+    import asyncio
+    from breve.profiler import profile
+    from breve.template import _cache
+    _cache.scache.invalidate('test_render_async_cache')
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return 'x'
+
+    async def render(t):
+        chunks = t.render_async('index', dict(value=fetch), fragment=True)
+        return ''.join([c async for c in chunks])
+
+    t = Template(html, root=template_root())
+    with profile() as p:
+        assert asyncio.run(render(t)) == expected_output()
+        assert asyncio.run(render(t)) == expected_output()
+    assert len(calls) == 3
+    assert p.stats[('include', 'fragment.b')][0] == 2
+
+
+def test_precompile():
+    """folding static subtrees gives the same output"""
+    params = dict(
+        message='hello, from breve',
+        title='test_simple_template',
+        url_data=[dict(url='http://www.google.com', label='Google')]
+    )
+    for name in ('test_simple_template', 'test_nested_inheritance', 'test_loop_include',
+                 'test_macros_inside_inherits', 'test_loop_macros',
+                 # tag names the template rebinds itself
+                 'test_precompile_assign', 'test_precompile_macro', 'test_precompile_macro_call'):
+        root = os.path.join(os.path.dirname(template_root()), name)
+        expected = Template(html, root=root).render('index', params, namespace='v')
+        t = Template(html, root=root, precompile=True)
+        assert t.render('index', params, namespace='v') == expected
+        assert t.render('index', params, namespace='v') == expected
+
+
+def test_precompile_folding():
+    """static subtrees are flattened at compile time"""
+    from breve.compiler import StaticCompiler
+    t = Template(html)
+    source = ("html[head[title['static & <title>']], body[div(class_='x')[E.nbsp, br, 'text'],"
+              " p[message], p(class_=css)['static'], p(render=r)[span['static']]]]")
+    code, names = StaticCompiler(t.tags).compile(source, 'test')
+    assert ('<head><title>static &amp; &lt;title&gt;</title></head>') in code.co_consts
+    assert '<div class="x">&#160;<br />text</div>' in code.co_consts
+    assert '<span>static</span>' not in code.co_consts
+    assert names == frozenset(['head', 'title', 'div', 'E', 'br'])
+    # names rebound with assign() or macro() and subtrees that fail aren't folded
+    code, names = StaticCompiler(t.tags).compile(
+        "assign('title', 'x'), macro('menu', lambda: ul[li['a']]), "
+        "div[h1[title], menu(), span('odd'), em['static']]", 'test')
+    assert '<em>static</em>' in code.co_consts
+    assert names == frozenset(['em'])
+
+
+def test_cache_dir():
+    """compiled templates are kept on disk"""
+    import tempfile
+    import breve.cache
+    from breve.template import _cache
+    params = dict(
+        message='hello, from breve',
+        title='test_simple_template'
+    )
+    root = os.path.join(os.path.dirname(template_root()), 'test_simple_template')
+    expected = Template(html, root=root).render('index', params, namespace='v')
+    with tempfile.TemporaryDirectory() as cache_dir:
+        _cache.ccache.clear()
+        t = Template(html, root=root, cache_dir=cache_dir)
+        assert t.render('index', params, namespace='v') == expected
+        assert len(os.listdir(cache_dir)) == 1
+
+        def no_compile(*args):
+            raise AssertionError('template compiled again')
+        _cache.ccache.clear()
+        breve.cache.compile = no_compile
+        try:
+            assert t.render('index', params, namespace='v') == expected
+        finally:
+            del breve.cache.compile
+
+
+def test_check_interval():
+    """template changes are picked up according to check_interval"""
+    import tempfile
+    from breve.template import _cache
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'index.b')
+
+        def write(text, mtime):
+            with open(path, 'w') as f:
+                f.write('div [ %r ]' % text)
+            os.utime(path, (mtime, mtime))
+
+        write('one', 1000000000)
+        frozen = Template(html, root=root, check_interval=None)
+        always = Template(html, root=root)
+        assert frozen.render('index', fragment=True) == '<div>one</div>'
+        write('two', 1000000001)
+        assert frozen.render('index', fragment=True) == '<div>one</div>'
+        assert always.render('index', fragment=True) == '<div>two</div>'
+        _cache.refresh()
+        assert frozen.render('index', fragment=True) == '<div>two</div>'
+
+
 def test_include():
     """include() directive"""
     params = dict(
@@ -91,6 +286,80 @@ def test_loop_include():
     assert actual == expected
 
 
+def test_include_cache():
+    """fragments included in a loop are compiled once per render"""
+    import tempfile
+    from breve.loaders import FileLoader
+    stats = []
+
+    class CountingLoader(FileLoader):
+        def stat(self, template, root):
+            stats.append(template)
+            return FileLoader.stat(self, template, root)
+
+    loader = CountingLoader()
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, 'index.b'), 'w') as f:
+            f.write("ul [ [ include('item', dict(i=i)) for i in range(3) ] ]")
+        item = os.path.join(root, 'item.b')
+
+        def write(text, mtime):
+            with open(item, 'w') as f:
+                f.write(text)
+            os.utime(item, (mtime, mtime))
+
+        write('li [ i ]', 1000000000)
+        t = Template(html, root=root)
+        assert t.render('index', loader=loader, fragment=True) == (
+            '<ul><li>0</li><li>1</li><li>2</li></ul>')
+        assert stats == ['index.b', 'item.b']
+        write('li [ i * 2 ]', 1000000001)
+        assert t.render('index', loader=loader, fragment=True) == (
+            '<ul><li>0</li><li>2</li><li>4</li></ul>')
+        assert stats == ['index.b', 'item.b'] * 2
+
+
+def test_parallel_include():
+    """included fragments flattened on an executor"""
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    threads = []
+
+    def where():
+        threads.append(threading.current_thread().name)
+        return 'x'
+
+    with ThreadPoolExecutor(2, thread_name_prefix='fragment') as executor:
+        t = Template(html, root=template_root(), executor=executor)
+        actual = t.render('index', dict(where=where), fragment=True)
+    assert actual == expected_output()
+    assert len(threads) == 3 and all(n.startswith('fragment') for n in threads)
+
+
+def test_parallel_include_namespace():
+    """fragments flattened on an executor don't change the caller's namespace"""
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    inside, resume = threading.Event(), threading.Event()
+
+    def in_base():
+        # base.b is evaluated on the executor while index.b includes b.b
+        inside.set()
+        resume.wait(5)
+        return ''
+
+    params = dict(
+        in_base=in_base,
+        wait_for_base=lambda: inside.wait(5) and '',
+        release_base=lambda: resume.set() or ''
+    )
+    with ThreadPoolExecutor(2) as executor:
+        t = Template(html, root=template_root(), executor=executor)
+        actual = t.render('index', params, fragment=True)
+    assert inside.is_set()
+    assert actual == expected_output()
+
+
 def test_assign_scope():
     """test assign directive's scope"""
     params = dict(
@@ -157,6 +426,61 @@ def test_macro_includes():
     assert actual == expected
 
 
+def test_profile():
+    """render time, calls and output size per template, include and macro"""
+    from breve.profiler import profile
+    params = dict(message='hello, from breve', title=my_name())
+    root = os.path.join(os.path.dirname(template_root()), 'test_macro_includes')
+    t = Template(html, root=root)
+    with profile() as p:
+        actual = t.render('index', params, namespace='v')
+    assert actual == Template(html, root=root).render('index', params, namespace='v')
+    stats = dict(((r['kind'], r['name']), r) for r in p.report())
+    assert stats[('template', 'index.b')]['calls'] == 1
+    assert stats[('template', 'index.b')]['size'] == len(actual.split('\n', 2)[2])
+    assert stats[('include', 'include.b')]['calls'] == 1
+    assert stats[('include', 'include.b')]['size'] == len('<span>hello, from breve</span>')
+    assert stats[('macro', 'include_macro')]['calls'] == 1
+    assert stats[('flattener', 'str')]['calls'] >= 2
+    assert all(r['time'] >= 0 for r in stats.values())
+
+    # parent templates, streamed, and includes flattened on an executor
+    from concurrent.futures import ThreadPoolExecutor
+    root = os.path.join(os.path.dirname(template_root()), 'test_nested_inheritance')
+    with profile() as p:
+        actual = ''.join(Template(html, root=root).render_iter('index', params, namespace='v'))
+    stats = dict(((r['kind'], r['name']), r) for r in p.report())
+    assert stats[('template', 'master.b')]['calls'] == 1
+    for name in ('layout.b', 'master.b'):
+        assert stats[('template', name)]['size'] == len(actual.split('\n', 2)[2])
+    root = os.path.join(os.path.dirname(template_root()), 'test_macro_includes')
+    with ThreadPoolExecutor(2) as executor, profile() as p:
+        Template(html, root=root, executor=executor).render('index', params, namespace='v')
+    stats = dict(((r['kind'], r['name']), r) for r in p.report())
+    assert stats[('include', 'include.b')]['size'] == len('<span>hello, from breve</span>')
+
+
+def test_shared_template():
+    """one template rendering concurrently in several threads"""
+    from concurrent.futures import ThreadPoolExecutor
+    root = os.path.dirname(template_root())
+    inheriting = Template(html, root=os.path.join(root, 'test_nested_inheritance'))
+    stacking = Template(html, root=os.path.join(root, 'test_stacks_template'))
+
+    def render(i):
+        params = dict(title='title %d' % i, message='message %d' % i)
+        return (inheriting.render('index', params, namespace='v'),
+                stacking.render('index', params, namespace='v'))
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(render, range(200)))
+    for i, (inherited, stacked) in enumerate(results):
+        assert '<title>title %d</title>' % i in inherited
+        assert '<div>message %d</div>' % i in inherited
+        assert ('<div>message %d this is string 2 this is string 1</div>' % i) in stacked
+    assert not get_stacks()
+
+
 def test_simple_inheritance():
     """simple inheritance"""
     params = dict(
@@ -182,6 +506,23 @@ def test_nested_inheritance():
     assert actual == expected
 
 
+def test_inheritance_chain():
+    """parent templates are evaluated in the child's flattening pass"""
+    from breve.profiler import profile
+    params = dict(message='hello, from breve', title='test_nested_inheritance')
+    root = os.path.join(os.path.dirname(template_root()), 'test_nested_inheritance')
+    t = Template(html, root=root)
+    expected = t.render('index', params, namespace='v')
+    with profile() as p:
+        assert ''.join(t.render_iter('index', params, namespace='v', bufsize=1)) == expected
+    assert p.stats[('template', 'layout.b')][0] == 1
+    assert p.stats[('template', 'master.b')][0] == 1
+    # outside of renders
+    inherits, override = t.tags['inherits'], t.tags['override']
+    assert str(inherits('master')[override('title')['x']]) == (
+        '<html><head><title>x</title></head><body></body></html>')
+
+
 def test_macros_inside_inherits():
     """test macros inside inherits(): scope issues"""
     # note: I'm not convinced this is the desired behaviour, but
@@ -210,6 +551,40 @@ def test_register_global():
     assert actual == expected
 
 
+def test_fragment_cache():
+    """cache() directive"""
+    from breve.template import _cache
+    _cache.scache.invalidate_prefix(my_name())
+    t = Template(html, root=template_root())
+    t.render('index', dict(title=my_name(), counter=1), namespace='v')
+    actual = t.render('index', dict(title=my_name(), counter=2), namespace='v')
+    expected = expected_output()
+    assert actual == expected
+
+
+def test_register_global_after_render():
+    """globals registered between renders are picked up"""
+    root = os.path.join(os.path.dirname(template_root()), 'test_register_global')
+    params = dict(title='test_register_global')
+    register_global('global_message', 'first')
+    t = Template(html, root=root)
+    assert '<div>first</div>' in t.render('index', params, namespace='v')
+    register_global('global_message', 'second')
+    assert '<div>second</div>' in t.render('index', params, namespace='v')
+
+
+def test_tags_after_render():
+    """tags changed between renders are picked up"""
+    from breve.tags.html import HtmlProto
+    for precompile in (False, True):
+        t = Template(html, root=template_root(), precompile=precompile)
+        t.tags.update(mytag='first', box=HtmlProto('b'))
+        assert t.render('index', fragment=True) == '<div>first<b>x</b></div>'
+        t.tags['mytag'] = 'second'
+        t.tags['box'] = HtmlProto('i')
+        assert t.render('index', fragment=True) == '<div>second<i>x</i></div>'
+
+
 def test_stacks():
     """test stacks (push/pop)"""
     push(a=1, b=2)
@@ -290,6 +665,63 @@ def test_custom_renderer_notag():
     assert actual == expected
 
 
+def test_lazy_data():
+    """lazy data providers and renderers run once per render"""
+    from breve.tags import Lazy
+    calls = []
+
+    def load(n):
+        calls.append('load')
+        return list(range(n))
+
+    def render_list(tag, data):
+        calls.append('render')
+        tag.clear()
+        return tag[[html.li[i] for i in data]]
+
+    t = Template(html, root=template_root())
+    params = dict(rows=Lazy(load, 2), render_list=render_list)
+    params['items'] = html.ol(render=render_list, data=params['rows'])
+    for _i in range(2):
+        del calls[:]
+        assert t.render('index', params, fragment=True) == expected_output()
+        assert calls == ['load', 'render', 'render']
+
+
+def test_lazy_data_executor():
+    """lazy data providers and renderers run once per render on an executor too"""
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from breve.tags import Lazy
+    calls = []
+
+    def overlap(barrier):
+        # the other fragment's thread gets here too, unless it waits for this one
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+
+    def load(n):
+        calls.append('load')
+        overlap(loading)
+        return list(range(n))
+
+    def render_list(tag, data):
+        calls.append('render')
+        overlap(rendering)
+        tag.clear()
+        return tag[[html.li[i] for i in data]]
+
+    loading, rendering = threading.Barrier(2, timeout=0.2), threading.Barrier(2, timeout=0.2)
+    params = dict(rows=Lazy(load, 2))
+    params['items'] = html.ol(render=render_list, data=params['rows'])
+    with ThreadPoolExecutor(2) as executor:
+        t = Template(html, root=template_root(), executor=executor)
+        assert t.render('index', params, fragment=True) == expected_output()
+    assert calls == ['load', 'render']
+
+
 def test_custom_loader():
     """custom loader"""
     class PathLoader(object):
@@ -308,7 +740,7 @@ def test_custom_loader():
             raise OSError('No such file or directory %s' % template)
 
         def load(self, uid):
-            return open(uid, 'U').read()
+            return open(uid).read()
 
     loader = PathLoader(
         template_root(),
@@ -346,7 +778,7 @@ def test_custom_loader_stack():
             raise OSError('No such file or directory %s' % template)
 
         def load(self, uid):
-            return open(uid, 'U').read()
+            return open(uid).read()
 
     loader = PathLoader(
         template_root(),
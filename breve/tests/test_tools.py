@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from breve.flatten import flatten
-from breve.plugin.helpers import render_decorator
+from breve.plugin.helpers import get_template, render_decorator
 from breve.tags.entities import entities
 from breve.tags.html import tags
 from breve.tests.lib import expected_output, template_root, test_root
@@ -39,3 +39,35 @@ def test_render_decorator():
     actual = render_test()
     expected = expected_output()
     assert actual == expected
+
+
+def test_get_template():
+    """templates are pooled by configuration"""
+    t = get_template(tags, root=template_root(), namespace='v')
+    assert get_template(tags, root=template_root(), namespace='v') is t
+    assert get_template(tags, root=template_root()) is not t
+    assert get_template(dict(tags), root=template_root()) is not \
+        get_template(dict(tags), root=template_root())
+
+
+def test_get_template_preamble():
+    """preamble() and render options don't leak between users of a pooled template"""
+    from breve.plugin import helpers
+    custom = render_decorator('custom', root=template_root())(lambda: {})
+    plain = render_decorator('plain', root=template_root())(lambda: {})
+    assert custom().split('\n')[1:] == ['<!DOCTYPE custom>', '<p>custom</p>']
+    assert plain().split('\n')[1:] == ['', '<p>plain</p>']
+    t = get_template(tags, root=template_root())
+    t.render('plain', namespace='v')
+    assert t.namespace == ''
+    for i in range(helpers._max_templates + 1):
+        get_template(tags, root='pool-%d' % i)
+    assert len(helpers._templates) == helpers._max_templates
+
+
+def test_benchmarks():
+    """every benchmark runs and reports its timings"""
+    from breve.benchmarks import benchmarks, run
+    results = run(number=1, repeat=1)
+    assert sorted(results['benchmarks']) == sorted(benchmarks)
+    assert all(r['best'] > 0 for r in results['benchmarks'].values())
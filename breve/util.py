@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-import collections
+import collections.abc
 import itertools
 import sys
 
@@ -35,26 +35,89 @@ class Namespace(object):
                 # return 'Unknown identifier:%s' % k
 
 
+class VersionedDict(dict):
+    """dict counting its changes in version, so that copies can be kept up to date"""
+    __slots__ = ['version']
+
+    def __init__(self, *args, **kw):
+        dict.__init__(self, *args, **kw)
+        self.version = 0
+
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, v)
+        self.version += 1
+
+    def __delitem__(self, k):
+        dict.__delitem__(self, k)
+        self.version += 1
+
+    def update(self, *args, **kw):
+        dict.update(self, *args, **kw)
+        self.version += 1
+
+    def setdefault(self, k, default=None):
+        self.version += 1
+        return dict.setdefault(self, k, default)
+
+    def pop(self, *args):
+        self.version += 1
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.version += 1
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self.version += 1
+
+
+# quoted ' name="value"' strings for attributes with immutable values
+_quoted = {}
+_cacheable = frozenset([str, int, float])
+
+
+def quoteattr(a, v):
+    """
+    Escape and quote a single attribute value, returning ' a="v"'.
+    """
+    if isinstance(v, bytes):
+        v = str(v, 'utf-8')
+    elif not isinstance(v, str):
+        v = str(v)
+    if '&' in v or '<' in v or '>' in v or '"' in v:
+        v = v.replace(u"&", u"&amp;"
+                      ).replace(u">", u"&gt;"
+                                ).replace(u"<", u"&lt;"
+                                          ).replace(u'"', u"&quot;")
+    return u' %s="%s"' % (a, v)
+
+
 def quoteattrs(attrs):
     """
     Escape and quote a dict of attribute/value pairs.
 
     Escape &, <, and > in a string of data, then quote it for use as
     an attribute value.  The " character will be escaped as well.
-    Also filter out None values.
+    Also filter out None values.  Results for immutable values are
+    cached, as the same attributes tend to recur on every render.
     """
     quoted = []
     for a, v in attrs.items():
         if v is None:
             continue
-        if not isinstance(v, str):
-            v = str(v, 'utf-8')
-
-        v = u'"' + v.replace(u"&", u"&amp;"
-                             ).replace(u">", u"&gt;"
-                                       ).replace(u"<", u"&lt;"
-                                                 ).replace(u'"', u"&quot;") + u'"'
-        quoted.append(u' %s=%s' % (a, v))
+        t = type(v)
+        if t in _cacheable:
+            key = (t, a, v)
+            q = _quoted.get(key)
+            if q is None:
+                q = quoteattr(a, v)
+                if len(_quoted) > 4096:
+                    _quoted.clear()
+                _quoted[key] = q
+        else:
+            q = quoteattr(a, v)
+        quoted.append(q)
     return quoted
 
 
@@ -62,9 +125,13 @@ def escape(s):
     """
     Escape &, <, and > in a string of data.
     """
-    return s.replace("&", "&amp;"
-                     ).replace(">", "&gt;"
-                               ).replace("<", "&lt;")
+    # checking first is much cheaper than replacing in the common case
+    # of text without any of them
+    if '&' in s or '<' in s or '>' in s:
+        return s.replace("&", "&amp;"
+                         ).replace(">", "&gt;"
+                                   ).replace("<", "&lt;")
+    return s
 
 
 def caller():
@@ -152,7 +219,7 @@ class odict(collections.OrderedDict):
             args = izip_flat_pairs(args),
         if args:
             other = args[0]
-            if isinstance(other, collections.Mapping):
+            if isinstance(other, collections.abc.Mapping):
                 for key in other:
                     self[key] = other[key]
             elif hasattr(other, "keys"):